@@ -16,10 +16,14 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301 USA.
 
+import collections
 import errno
+import mmap
 import os
 import signal
+import tempfile
 import threading
+import time
 
 import gobject
 
@@ -100,11 +104,13 @@ class ChildProcess(object):
     def __init__(self, dispatcher, pid):
         self.pid = pid
         self.state = "running"
+        self.status = None
         self._status_handlers = shell_event.EventDistributor()
         self.add_status_handler = self._status_handlers.add
         dispatcher.add_handler(pid, self._status_handler)
 
     def _status_handler(self, status):
+        self.status = status
         if os.WIFSTOPPED(status):
             self.state = "stopped"
         else:
@@ -112,14 +118,81 @@ class ChildProcess(object):
         self._status_handlers.send(status)
 
 
+# Builtins whose output may be large run a process to write it,
+# rather than writing it from the shell.  In the terminal, the shell's
+# main loop reads the other end of the tty, so a large write from the
+# shell would block forever.
+def spawn_helper(job_procs, spec, args, stdin=None):
+    spec = spec.copy()
+    spec["fds"] = spec["fds"].copy()
+    spec["args"] = args
+    if stdin is not None:
+        spec["fds"][0] = stdin
+    job_procs.append(spec)
+
+
+# Amount of output kept for each job, for "jobs -o".
+JOB_OUTPUT_SIZE = 256 * 1024
+
+# Number of finished jobs whose output is kept for "jobs -o".
+MAX_FINISHED_OUTPUTS = 10
+
+# Larger output buffers are kept in a temporary file, through mmap,
+# so that the kernel can write them out rather than keeping them in
+# memory.
+MAX_MEMORY_OUTPUT_SIZE = 1 << 20
+
+
+# Keeps the last "size" bytes written to it.
+class OutputRing(object):
+
+    def __init__(self, size=JOB_OUTPUT_SIZE):
+        self._size = size
+        if size <= MAX_MEMORY_OUTPUT_SIZE:
+            self._buffer = bytearray(size)
+        else:
+            fh = tempfile.TemporaryFile(prefix="job-output-")
+            fh.truncate(size)
+            self._buffer = mmap.mmap(fh.fileno(), size)
+            fh.close()
+        # Total number of bytes written.
+        self._end = 0
+
+    def write(self, data):
+        self._end += len(data)
+        if len(data) > self._size:
+            data = data[-self._size:]
+        pos = (self._end - len(data)) % self._size
+        first = min(len(data), self._size - pos)
+        self._buffer[pos:pos + first] = data[:first]
+        self._buffer[:len(data) - first] = data[first:]
+
+    def get_dropped_size(self):
+        return max(self._end - self._size, 0)
+
+    # Returns the output we have kept.  If some has been dropped, this
+    # starts at a line boundary.
+    def get_tail(self):
+        if self._end <= self._size:
+            return str(self._buffer[:self._end])
+        pos = self._end % self._size
+        data = str(self._buffer[pos:]) + str(self._buffer[:pos])
+        return data[data.find("\n") + 1:]
+
+
 class Job(object):
 
-    def __init__(self, procs, pgid, cmd_text, to_foreground):
+    def __init__(self, procs, pgid, cmd_text, to_foreground, output=None):
         self.procs = procs
         self.pgid = pgid
         self.state = "running"
         self.cmd_text = cmd_text
         self.to_foreground = to_foreground
+        # An OutputRing with the output from the job's tty, if it has
+        # its own tty.
+        self.output = output
+        self.start_time = time.time()
+        self.end_time = None
         self._on_state_change = shell_event.EventDistributor()
         self.add_state_change_handler = self._on_state_change.add
         for proc in self.procs:
@@ -129,6 +202,8 @@ class Job(object):
         old_state = self.state
         self.state = self._get_state()
         if self.state != old_state:
+            if self.state != "running":
+                self.end_time = time.time()
             self._on_state_change.send()
 
     def _get_state(self):
@@ -139,6 +214,20 @@ class Job(object):
         else:
             return "stopped"
 
+    # Returns the exit status in the form used by Bash's $?, which is
+    # that of the last process in the pipeline.
+    def get_exit_status(self):
+        status = self.procs[-1].status
+        if status is None:
+            return None
+        if os.WIFEXITED(status):
+            return os.WEXITSTATUS(status)
+        if os.WIFSIGNALED(status):
+            return 128 + os.WTERMSIG(status)
+        if os.WIFSTOPPED(status):
+            return 128 + os.WSTOPSIG(status)
+        return None
+
     def send_signal(self, signal_number):
         os.kill(-self.pgid, signal_number)
 
@@ -197,11 +286,13 @@ class ProcessGroupJobSpawner(object):
 
 class SessionJobSpawner(object):
 
-    def __init__(self, dispatcher, job_controller, tty_fd, to_foreground):
+    def __init__(self, dispatcher, job_controller, tty_fd, to_foreground,
+                 output=None):
         self._dispatcher = dispatcher
         self._job_controller = job_controller
         self._tty_fd = tty_fd
         self._to_foreground = to_foreground
+        self._output = output
 
     # Start a job with a new controlling tty.
     def start_job(self, job_procs, is_foreground, cmd_text):
@@ -214,7 +305,7 @@ class SessionJobSpawner(object):
         job_procs[:] = []
         procs = [ChildProcess(dispatcher_for_job, proc) for proc in pids]
         pgid = pids[0]
-        job = Job(procs, pgid, cmd_text, self._to_foreground)
+        job = Job(procs, pgid, cmd_text, self._to_foreground, self._output)
         self._job_controller.add_job(job, is_foreground)
 
 
@@ -226,6 +317,12 @@ class JobController(object):
         self._tty_fd = tty_fd
         self._state_changed = set()
         self.jobs = {}
+        # Maps job ID to the OutputRing of a background job that has
+        # finished, oldest first, so that "jobs -o" can still show it.
+        self.finished_output = collections.OrderedDict()
+        # Exit status and duration of the last foreground job.
+        self.last_status = 0
+        self.last_duration = None
         self._awaiting_job = None
         self._done_handlers = shell_event.EventDistributor()
         self.add_done_handler = self._done_handlers.add
@@ -234,13 +331,16 @@ class JobController(object):
         def on_state_change():
             self._state_changed.add((job_id, job))
             if self._awaiting_job == job_id and job.state != "running":
+                self.last_status = job.get_exit_status()
+                self.last_duration = job.end_time - job.start_time
                 if job.state == "finished":
                     self._state_changed.remove((job_id, job))
                     del self.jobs[job_id]
                 self._done_handlers.send()
                 self._awaiting_job = None
 
-        job_id = max([0] + self.jobs.keys()) + 1
+        # Don't reuse the ID of a finished job whose output is kept.
+        job_id = max([0] + self.jobs.keys() + self.finished_output.keys()) + 1
         self.jobs[job_id] = job
         job.add_state_change_handler(on_state_change)
         if is_foreground:
@@ -277,10 +377,53 @@ class JobController(object):
             elif job.state == "finished":
                 self._job_status_change(job_id, job)
                 del self.jobs[job_id]
+                if job.output is not None:
+                    self._keep_output(job_id, job.output)
         self._state_changed.clear()
 
+    def _keep_output(self, job_id, output):
+        self.finished_output[job_id] = output
+        while len(self.finished_output) > MAX_FINISHED_OUTPUTS:
+            self.finished_output.popitem(last=False)
+
+    # Returns the OutputRing of the job given in args, which may have
+    # finished, or None after printing an error.
+    def _get_output(self, args, stderr):
+        outputs = dict(self.finished_output)
+        for job_id, job in self.jobs.iteritems():
+            outputs[job_id] = job.output
+        if len(args) == 0:
+            if len(outputs) == 0:
+                stderr.write("jobs: no current job\n")
+                return None
+            job_id = max(outputs)
+        else:
+            try:
+                job_id = int(args[0])
+            except ValueError:
+                job_id = None
+            if len(args) > 1 or job_id not in outputs:
+                stderr.write("jobs: no such job %s\n" % " ".join(args))
+                return None
+        if outputs[job_id] is None:
+            stderr.write("jobs: no output kept for job %i\n" % job_id)
+        return outputs[job_id]
+
+    # "jobs -o ID" shows the end of a job's output.
     def _list_jobs(self, new_job, spec):
         stdout = spec["fds"][1]
+        if len(spec["args"]) > 0 and spec["args"][0] == "-o":
+            output = self._get_output(spec["args"][1:], spec["fds"][2])
+            if output is None:
+                return
+            fh = tempfile.TemporaryFile(prefix="job-output-")
+            dropped = output.get_dropped_size()
+            if dropped > 0:
+                fh.write("[%i earlier bytes not kept]\n" % dropped)
+            fh.write(output.get_tail())
+            fh.seek(0)
+            spawn_helper(new_job, spec, ["cat"], stdin=fh)
+            return
         for job_id, job in sorted(self.jobs.iteritems()):
             stdout.write("[%s] %s  %s\n" % (job_id, state_map[job.state],
                                             job.cmd_text))
@@ -25,16 +25,21 @@ import optparse
 import os
 import pwd
 import signal
-import socket
 import sqlite3
 import string
 import sys
+import threading
+import time
 import traceback
 
 import gobject
 import pyparsing as parse
 
 import jobcontrol
+import shell_complete
+import shell_prompt
+import shell_recording
+import shell_suggest
 
 
 FILENO_STDIN = 0
@@ -63,7 +68,7 @@ class ExpandStringArgument(object):
     def eval(self, spec):
         string = os.path.expanduser(self._string)
         if self._do_glob:
-            matches = sorted(spec["cwd"].relative_op(lambda: glob.glob(string)))
+            matches = sorted(spec["cwd"].glob(string))
             if len(matches) > 0:
                 spec["args"].extend(matches)
                 return
@@ -89,8 +94,7 @@ class RedirectFile(object):
 
     def eval(self, spec):
         filename = os.path.expanduser(self._filename)
-        spec["fds"][self._dest_fd] = \
-            spec["cwd"].relative_op(lambda: open(filename, self._mode))
+        spec["fds"][self._dest_fd] = spec["cwd"].open(filename, self._mode)
 
 
 def copy_spec(spec):
@@ -231,11 +235,70 @@ def make_chdir_builtin(cwd_tracker, environ):
     return chdir_builtin
 
 
+def make_jump_builtin(cwd_tracker, history):
+    def jump_builtin(job, spec):
+        try:
+            current = cwd_tracker.get_cwd()
+        except OSError:
+            current = None
+        for path in history.find_directories(spec["args"]):
+            if path == current:
+                continue
+            try:
+                cwd_tracker.chdir(path)
+            except OSError:
+                # The directory may have been removed since we
+                # recorded it.  Fall back to the next best match.
+                continue
+            return
+        spec["fds"][FILENO_STDERR].write("j: no matching directory\n")
+    return jump_builtin
+
+
+# Number of commands listed by "history" with no arguments.
+HISTORY_LIST_LENGTH = 20
+
+
+# "history" lists recent commands with their IDs.  "history
+# show-output ID" prints the recorded output of a command.
+def make_history_builtin(history, output_store):
+    def history_builtin(job, spec):
+        args = spec["args"]
+        stdout = spec["fds"][FILENO_STDOUT]
+        stderr = spec["fds"][FILENO_STDERR]
+        if len(args) == 0:
+            for history_id, command in history.get_recent(
+                    HISTORY_LIST_LENGTH):
+                stdout.write("%6i  %s\n" % (history_id, command))
+        elif len(args) == 2 and args[0] == "show-output":
+            try:
+                history_id = int(args[1])
+            except ValueError:
+                stderr.write("history: bad ID: %s\n" % args[1])
+                return
+            path = None
+            if output_store is not None:
+                path = output_store.get_recording_path(history_id)
+            if path is None:
+                stderr.write("history: no output recorded for %i\n"
+                             % history_id)
+            else:
+                # Decoding a recording can take a while and its output
+                # can be large, so this is done by a child process.
+                jobcontrol.spawn_helper(
+                    job, spec, [sys.executable, shell_recording.SCRIPT_PATH,
+                                "show-output", path])
+        else:
+            stderr.write("Usage: history [show-output ID]\n")
+    return history_builtin
+
+
 class LauncherWithBuiltins(object):
 
-    def __init__(self, launcher, builtins):
+    def __init__(self, launcher, builtins, command_corrector=None):
         self._launcher = launcher
         self._builtins = builtins
+        self._command_corrector = command_corrector
 
     def spawn(self, job, spec):
         builtin = self._builtins.get(spec["args"][0])
@@ -244,6 +307,20 @@ class LauncherWithBuiltins(object):
             spec["args"] = spec["args"][1:]
             return builtin(job, spec)
         else:
+            if self._command_corrector is not None:
+                # Work out the suggestions here so that the child
+                # process can print them if exec() fails.  This is
+                # only worth doing if the command won't be found.
+                command = spec["args"][0]
+                path = resolve_search_path(
+                    spec["cwd"],
+                    spec.get("environ", os.environ).get("PATH", ""))
+                if not shell_complete.is_on_path(path, command):
+                    suggestions = self._command_corrector.suggest(
+                        path, command, self._builtins.keys())
+                    if len(suggestions) > 0:
+                        spec = copy_spec(spec)
+                        spec["command_suggestions"] = suggestions
             return self._launcher.spawn(job, spec)
 
 
@@ -313,15 +390,37 @@ class FDWrapper(object):
         return self._fd
 
 
+# Cwd trackers provide operations on pathnames relative to the cwd
+# they track.  get_path() converts such a pathname into one that can
+# be used regardless of the process's cwd.
+
+class CwdTrackerMixin(object):
+
+    def open(self, path, mode="r"):
+        return open(self.get_path(path), mode)
+
+    def stat(self, path):
+        return os.stat(self.get_path(path))
+
+    def listdir(self, path):
+        return os.listdir(self.get_path(path))
+
+    def glob(self, pattern):
+        if os.path.isabs(pattern):
+            return glob.glob(pattern)
+        prefix = self.get_path("")
+        return [path[len(prefix):] for path in glob.glob(prefix + pattern)]
+
+
 # gnome-terminal uses a process's cwd when opening new tabs/windows,
 # so it's still useful to set the process-global cwd.
-class GlobalCwdTracker(object):
+class GlobalCwdTracker(CwdTrackerMixin):
 
     def get_cwd_fd(self):
         return FDWrapper(os.open(".", os.O_RDONLY))
 
-    def relative_op(self, func):
-        return func()
+    def get_path(self, path):
+        return path
 
     def get_cwd(self):
         return os.getcwd()
@@ -333,7 +432,7 @@ class GlobalCwdTracker(object):
         return os.stat(".")
 
 
-class LocalCwdTracker(object):
+class LocalCwdTracker(CwdTrackerMixin):
 
     def __init__(self, cwd_fd=None):
         if cwd_fd is None:
@@ -343,41 +442,75 @@ class LocalCwdTracker(object):
     def get_cwd_fd(self):
         return self._cwd_fd
 
-    def relative_op(self, func):
-        # Not thread-safe.  Would be better to use *at() syscalls, but
-        # they are not readily available from Python, and not all
-        # calls have a *at() equivalent.  For example, there is no
-        # fgetcwd().
-        old_cwd = FDWrapper(os.open(".", os.O_RDONLY))
-        try:
-            os.fchdir(self._cwd_fd)
-            return func()
-        finally:
-            os.fchdir(old_cwd)
+    # Python 2 does not provide the *at() syscalls, but on Linux a
+    # pathname under /proc/self/fd/N/ has the same effect as passing
+    # N as the directory FD.  Unlike fchdir()ing to the directory and
+    # back, this is safe to use from several threads at once.
+    def get_path(self, path):
+        if os.path.isabs(path):
+            return path
+        return "/proc/self/fd/%i/%s" % (self._cwd_fd.fileno(), path)
 
     def get_cwd(self):
-        return self.relative_op(os.getcwd)
+        path = os.readlink("/proc/self/fd/%i" % self._cwd_fd.fileno())
+        # Match os.getcwd(), which fails if the directory was deleted.
+        if (path.endswith(" (deleted)") and
+            os.fstat(self._cwd_fd.fileno()).st_nlink == 0):
+            raise OSError(errno.ENOENT, "Directory has been deleted")
+        return path
 
     def chdir(self, dir_path):
-        self._cwd_fd = self.relative_op(
-            lambda: FDWrapper(os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)))
+        self._cwd_fd = FDWrapper(os.open(self.get_path(dir_path),
+                                         os.O_RDONLY | os.O_DIRECTORY))
 
     def get_stat(self):
         return os.fstat(self._cwd_fd.fileno())
 
+    def set_cwd_fd(self, cwd_fd):
+        self._cwd_fd = cwd_fd
+
     def copy(self):
         return LocalCwdTracker(self.get_cwd_fd())
 
 
+# LogicalCwd.get_cwd() is called several times for each command, so
+# its result is reused for this long unless the cwd is changed or a
+# job finishes (since the directory may have been renamed).
+CWD_CACHE_INTERVAL = 10 # seconds
+
+
 class LogicalCwd(object):
 
-    def __init__(self, cwd_tracker, environ):
+    def __init__(self, cwd_tracker, environ,
+                 cache_interval=CWD_CACHE_INTERVAL, get_time=time.time):
         self._cwd_tracker = cwd_tracker
         self._environ = environ
+        self._cache_interval = cache_interval
+        self._get_time = get_time
+        # (PWD value, cwd pathname, time of validation) or None.
+        self._cached = None
+
+    def invalidate(self):
+        self._cached = None
 
     def get_cwd_fd(self):
         return self._cwd_tracker.get_cwd_fd()
 
+    def get_path(self, path):
+        return self._cwd_tracker.get_path(path)
+
+    def open(self, path, mode="r"):
+        return self._cwd_tracker.open(path, mode)
+
+    def stat(self, path):
+        return self._cwd_tracker.stat(path)
+
+    def listdir(self, path):
+        return self._cwd_tracker.listdir(path)
+
+    def glob(self, pattern):
+        return self._cwd_tracker.glob(pattern)
+
     # Bash uses PWD to remember the cwd pathname before symlink expansion.
     def chdir(self, path):
         if os.path.isabs(path):
@@ -386,12 +519,23 @@ class LogicalCwd(object):
             new_cwd = os.path.join(self.get_cwd(), path)
         # Note that ".." is applied after symlink expansion.  We don't
         # attempt to follow Bash's behaviour here.
+        self.invalidate()
         self._cwd_tracker.chdir(path)
         # Only set this if chdir() succeeds.
         self._environ["PWD"] = os.path.normpath(new_cwd)
 
     def get_cwd(self):
-        path = self._environ.get("PWD")
+        pwd_path = self._environ.get("PWD")
+        now = self._get_time()
+        cached = self._cached
+        if (cached is not None and cached[0] == pwd_path and
+            now - cached[2] < self._cache_interval):
+            return cached[1]
+        cwd_path = self._get_cwd_uncached(pwd_path)
+        self._cached = (pwd_path, cwd_path, now)
+        return cwd_path
+
+    def _get_cwd_uncached(self, path):
         if path is not None:
             try:
                 stat1 = os.stat(path)
@@ -405,64 +549,183 @@ class LogicalCwd(object):
         return self._cwd_tracker.get_cwd()
 
 
-def remove_prefix(prefix, string):
-    assert string.startswith(prefix), (prefix, string)
-    return string[len(prefix):]
+def complete_path_command(path, prefix, executable_index=None, fuzzy=False):
+    if executable_index is None:
+        executable_index = shell_complete.ExecutableIndex()
+    if fuzzy:
+        return executable_index.fuzzy_complete(path, prefix)
+    return executable_index.complete(path, prefix)
+
 
+# Relative directories in PATH are looked up relative to the cwd.
+def resolve_search_path(cwd, path):
+    return ":".join(cwd.get_path(dir_path) for dir_path in path.split(":"))
 
-def complete_prefix_filename(filename):
+
+def complete_filename(string, directory_cache=None, fuzzy=False, cwd=None):
+    if directory_cache is None:
+        directory_cache = shell_complete.DirectoryCache()
+    if cwd is None:
+        cwd = GlobalCwdTracker()
+    if fuzzy:
+        complete = directory_cache.fuzzy_complete
+    else:
+        complete = directory_cache.complete
+    filename, reverse_expansion = expanduser(string)
     # We don't use glob for this because glob will collapse multiple
     # trailing slashes.  e.g. glob("foo//*") -> ["foo/bar"].
     # Also, we don't want stars in the filename to be interpreted by glob.
+    index = filename.rfind("/") + 1
+    dir_name = filename[:index]
     try:
-        if "/" in filename:
-            index = filename.rindex("/") + 1
-            dir_name = filename[:index]
-            leaf_prefix = filename[index:]
-            leaves = os.listdir(dir_name)
-        else:
-            dir_name = ""
-            leaf_prefix = filename
-            leaves = os.listdir(".")
-        for leaf in leaves:
-            if leaf.startswith(leaf_prefix):
-                yield dir_name + leaf
+        for leaf, is_dir in complete(cwd.get_path(dir_name or "."),
+                                     filename[index:]):
+            if is_dir:
+                # This treats symlinks to directories differently from
+                # Bash, but this might be considered an improvement.
+                yield reverse_expansion(dir_name + leaf) + "/"
+            else:
+                yield reverse_expansion(dir_name + leaf)
     except OSError:
         # Ignore non-existent directories.
         pass
 
 
-def complete_path_command(path, prefix):
-    for dir_path in path.split(":"):
-        for filename in complete_prefix_filename("%s/%s" % (dir_path, prefix)):
-            try:
-                st = os.stat(filename)
-            except OSError:
-                pass
-            else:
-                if st.st_mode & 0111 != 0:
-                    yield remove_prefix(dir_path + "/", filename)
+# Completion providers give the matches for arguments of particular
+# commands.  complete() is called (possibly from a worker thread) with
+# the cwd tracker and the arguments before the one being completed,
+# and returns the matches or None to fall back to completing
+# filenames.  Each provider is responsible for caching whatever is
+# expensive to compute.
 
+class DirectoryCompleter(object):
 
-def complete_filename(string):
-    filename, reverse_expansion = expanduser(string)
-    for filename in complete_prefix_filename(filename):
-        if os.path.isdir(filename):
-            # This treats symlinks to directories differently from Bash,
-            # but this might be considered an improvement.
-            yield reverse_expansion(filename) + "/"
+    def __init__(self, directory_cache):
+        self._directory_cache = directory_cache
+
+    def complete(self, cwd, args, string):
+        return [name for name in complete_filename(
+                string, self._directory_cache, cwd=cwd)
+                if name.endswith("/")]
+
+
+class JobCompleter(object):
+
+    def __init__(self, job_controller, complete_pids=False):
+        self._job_controller = job_controller
+        self._complete_pids = complete_pids
+
+    def complete(self, cwd, args, string):
+        # Take a copy because jobs may finish while we are running.
+        jobs = sorted(self._job_controller.jobs.items())
+        if self._complete_pids:
+            names = [str(proc.pid) for job_id, job in jobs
+                     for proc in job.procs if proc.state != "finished"]
         else:
-            yield reverse_expansion(filename)
+            names = [str(job_id) for job_id, job in jobs]
+        return [name for name in names if name.startswith(string)]
+
+
+GIT_SUBCOMMANDS = sorted([
+        "add", "bisect", "blame", "branch", "checkout", "cherry-pick",
+        "clean", "clone", "commit", "config", "diff", "fetch", "grep",
+        "init", "log", "merge", "mv", "pull", "push", "rebase", "reflog",
+        "remote", "reset", "restore", "revert", "rm", "show", "stash",
+        "status", "submodule", "switch", "tag", "worktree"])
+
+# Subcommands that take a ref, and which of those also take filenames.
+GIT_REF_SUBCOMMANDS = set([
+        "branch", "checkout", "cherry-pick", "diff", "log", "merge",
+        "rebase", "reset", "restore", "revert", "show", "switch", "tag"])
+GIT_FILE_SUBCOMMANDS = set(["checkout", "diff", "log", "reset", "restore"])
 
 
-def readline_complete(cwd, environ, context, string):
-    def func():
-        names = set()
-        if context.strip() == "":
-            names.update(complete_path_command(environ.get("PATH", ""), string))
-        names.update(complete_filename(string))
-        return sorted(names)
-    return cwd.relative_op(func)
+class GitCompleter(object):
+
+    def __init__(self, directory_cache, ref_index=None):
+        self._directory_cache = directory_cache
+        if ref_index is None:
+            ref_index = shell_complete.GitRefIndex()
+        self._ref_index = ref_index
+
+    def complete(self, cwd, args, string):
+        if len(args) == 0:
+            return shell_complete.names_with_prefix(GIT_SUBCOMMANDS, string)
+        if args[0] not in GIT_REF_SUBCOMMANDS:
+            return None
+        try:
+            cwd_path = cwd.get_cwd()
+        except OSError:
+            return None
+        names = list(self._ref_index.complete(cwd_path, string))
+        if args[0] in GIT_FILE_SUBCOMMANDS:
+            names.extend(complete_filename(string, self._directory_cache,
+                                           cwd=cwd))
+        return names
+
+
+def make_completion_providers(directory_cache, job_controller):
+    directories = DirectoryCompleter(directory_cache)
+    jobs = JobCompleter(job_controller)
+    return {"cd": directories,
+            "git": GitCompleter(directory_cache),
+            "fg": jobs,
+            "bg": jobs,
+            "kill": JobCompleter(job_controller, complete_pids=True)}
+
+
+# Passes each match to add_match() as soon as it is found, so that
+# callers running this in the background can show partial results.
+# add_match() may raise an exception to abandon the search.
+# In fuzzy mode, if nothing starts with the string, we fall back to
+# names containing its characters in order.  Returns True if the
+# matches were ranked this way, in which case they should not be
+# re-sorted.
+def stream_complete(cwd, environ, context, string, add_match,
+                    executable_index=None, directory_cache=None,
+                    fuzzy=False, get_usage_count=None, providers=None):
+    seen = set()
+    def add(name):
+        if name not in seen:
+            seen.add(name)
+            add_match(name)
+    words = context.split()
+    if providers is not None and len(words) > 0 and words[0] in providers:
+        names = providers[words[0]].complete(cwd, words[1:], string)
+        if names is not None:
+            for name in names:
+                add(name)
+            return False
+    path = resolve_search_path(cwd, environ.get("PATH", ""))
+    is_command = len(words) == 0
+    if is_command:
+        for name in complete_path_command(path, string, executable_index):
+            add(name)
+    for name in complete_filename(string, directory_cache, cwd=cwd):
+        add(name)
+    if len(seen) > 0 or not fuzzy or string.endswith("/"):
+        return False
+    matches = []
+    if is_command:
+        matches.extend(complete_path_command(path, string,
+                                             executable_index, fuzzy=True))
+    matches.extend(complete_filename(string, directory_cache, fuzzy=True,
+                                     cwd=cwd))
+    for name in shell_complete.rank_fuzzy_matches(
+        unique(matches), string, get_usage_count):
+        add(name)
+    return True
+
+
+def readline_complete(cwd, environ, context, string, executable_index=None,
+                      directory_cache=None, fuzzy=False,
+                      get_usage_count=None, providers=None):
+    names = []
+    if not stream_complete(cwd, environ, context, string, names.append,
+                           executable_index, directory_cache, fuzzy,
+                           get_usage_count, providers):
+        names.sort()
+    return names
 
 
 def wrap_sudo(as_root, user):
@@ -471,20 +734,26 @@ def wrap_sudo(as_root, user):
     return {"sudo": sudo}, SudoLauncher(user, as_root)
 
 
-def apply_format(cwd_tracker, format):
+def get_prompt_cwd(cwd_tracker):
     try:
-        cwd_path = unexpanduser(cwd_tracker.get_cwd())
+        return unexpanduser(cwd_tracker.get_cwd())
     except:
-        cwd_path = "?"
-    args = {"username": pwd.getpwuid(os.getuid()).pw_name,
-            "hostname": socket.gethostname(),
-            "cwd_path": cwd_path}
-    return (format % args).encode("utf-8")
+        return "?"
+
+
+# See shell_prompt.py for the escapes that can be used.
+PROMPT_TEMPLATE = r"\u@\H:\w$$ "
 
+TITLE_TEMPLATE = r"\u@\H: \w"
 
-PROMPT_FORMAT = u"%(username)s@%(hostname)s:%(cwd_path)s$$ "
 
-TITLE_FORMAT = u"%(username)s@%(hostname)s: %(cwd_path)s"
+def make_prompt_inputs(cwd_tracker, job_controller, vcs_status):
+    return {"cwd": functools.partial(get_prompt_cwd, cwd_tracker),
+            "time": time.time,
+            "status": lambda: job_controller.last_status,
+            "jobs": lambda: len(job_controller.jobs),
+            "duration": lambda: job_controller.last_duration,
+            "vcs": vcs_status}
 
 
 def make_shell(parts):
@@ -498,24 +767,69 @@ def make_shell(parts):
             parts["job_tty"]))
     parts.setdefault("environ", os.environ)
     parts.setdefault("real_cwd", GlobalCwdTracker())
-    parts.setdefault("cwd", LogicalCwd(parts["real_cwd"], parts["environ"]))
-    parts.setdefault("get_prompt", functools.partial(
-            apply_format, parts["cwd"], PROMPT_FORMAT))
-    parts.setdefault("get_title", functools.partial(
-            apply_format, parts["cwd"], TITLE_FORMAT))
+    parts.setdefault("cwd_cache_interval", CWD_CACHE_INTERVAL)
+    parts.setdefault("cwd", LogicalCwd(parts["real_cwd"], parts["environ"],
+                                       parts["cwd_cache_interval"]))
+    parts.setdefault("history", DummyHistory())
+    # Where command output is recorded, if anywhere.
+    parts.setdefault("output_store", None)
+    parts.setdefault("prompt_template", PROMPT_TEMPLATE)
+    parts.setdefault("title_template", TITLE_TEMPLATE)
+    parts.setdefault("prompt_dirtrim", 0)
+    # The git status is only computed if the prompt uses it.  Commands
+    # may change it without touching git's index, so it is recomputed
+    # after each one, in the background.
+    git_status = shell_prompt.GitStatus(parts["cwd"])
+    vcs_status = shell_prompt.AsyncInput(git_status.get_key,
+                                         git_status.compute)
+    parts["job_controller"].add_done_handler(git_status.invalidate)
+    parts["job_controller"].add_done_handler(vcs_status.invalidate)
+    parts.setdefault("add_prompt_update_handler",
+                     vcs_status.add_update_handler)
+    prompt_inputs = make_prompt_inputs(parts["cwd"], parts["job_controller"],
+                                       vcs_status)
+    parts.setdefault("get_prompt", shell_prompt.Prompt(
+            parts["prompt_template"], prompt_inputs,
+            parts["prompt_dirtrim"]).render)
+    parts.setdefault("get_title", shell_prompt.Prompt(
+            parts["title_template"], prompt_inputs,
+            parts["prompt_dirtrim"]).render)
+    parts.setdefault("executable_index", shell_complete.ExecutableIndex())
+    parts.setdefault("directory_cache", shell_complete.DirectoryCache())
+    parts.setdefault("fuzzy_completion", False)
+    parts.setdefault("completion_providers", make_completion_providers(
+            parts["directory_cache"], parts["job_controller"]))
+    completion_args = {"executable_index": parts["executable_index"],
+                       "directory_cache": parts["directory_cache"],
+                       "fuzzy": parts["fuzzy_completion"],
+                       "get_usage_count": parts["history"].get_usage_count,
+                       "providers": parts["completion_providers"]}
     parts.setdefault("completer", functools.partial(
-            readline_complete, parts["real_cwd"], parts["environ"]))
+            readline_complete, parts["real_cwd"], parts["environ"],
+            **completion_args))
+    parts.setdefault("stream_completer", functools.partial(
+            stream_complete, parts["real_cwd"], parts["environ"],
+            **completion_args))
+    parts.setdefault("get_recall_list", functools.partial(
+            parts["history"].get_recall_list, parts["cwd"]))
+    parts.setdefault("get_suggestion", functools.partial(
+            parts["history"].suggest, parts["cwd"]))
     parts.setdefault("builtins", {})
     parts["builtins"]["cd"] = make_chdir_builtin(parts["cwd"], parts["environ"])
+    parts["builtins"]["j"] = make_jump_builtin(parts["cwd"], parts["history"])
+    parts["builtins"]["history"] = make_history_builtin(
+        parts["history"], parts["output_store"])
     parts["builtins"].update(parts["job_controller"].get_builtins())
+    parts["job_controller"].add_done_handler(parts["cwd"].invalidate)
     launcher = Launcher()
     if "SUDO_USER" in os.environ and os.getuid() == 0:
         sudo_builtins, launcher = wrap_sudo(
             launcher, os.environ["SUDO_USER"])
         parts["builtins"].update(sudo_builtins)
-    parts.setdefault("launcher", LauncherWithBuiltins(launcher,
-                                                      parts["builtins"]))
-    parts.setdefault("history", DummyHistory())
+    parts.setdefault("command_corrector", shell_complete.CommandCorrector(
+            parts["executable_index"]))
+    parts.setdefault("launcher", LauncherWithBuiltins(
+            launcher, parts["builtins"], parts["command_corrector"]))
 
 
 def make_batch_shell():
@@ -526,21 +840,88 @@ def make_batch_shell():
 
 class DummyHistory(object):
 
+    # Returns the history ID of the command, if it is stored.
     def add_command(self, line, cwd):
+        return None
+
+    def get_recent(self, count):
+        return []
+
+    def get_recall_list(self, cwd):
+        # None means there is no stored history, so the reader should
+        # keep its own in-memory list.
+        return None
+
+    def find_directories(self, fragments):
+        return []
+
+    def suggest(self, cwd, prefix):
+        return None
+
+    def get_usage_count(self, name):
+        return 0
+
+    def poll(self):
         pass
 
 
+# Maximum number of rows fetched for each part of the recall list.
+RECALL_LIMIT = 1000
+
+# Directory scores for the "j" builtin are weighted by how recently
+# the directory was last used.  (seconds, weight) pairs.
+FRECENCY_WEIGHTS = [(60 * 60, 4),
+                    (24 * 60 * 60, 2),
+                    (7 * 24 * 60 * 60, 0.5)]
+FRECENCY_DEFAULT_WEIGHT = 0.25
+
+
+# Number of recent history rows used to seed command suggestions.
+SUGGESTION_LOAD_LIMIT = 100000
+
+
+def like_escape(string):
+    return (string.replace("\\", "\\\\")
+            .replace("%", "\\%").replace("_", "\\_"))
+
+
+def unique(items):
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+def get_state_dir():
+    shell_dir = os.path.expanduser("~/.shell2")
+    try:
+        os.mkdir(shell_dir)
+    except OSError, exn:
+        if exn.errno != errno.EEXIST:
+            raise
+    return shell_dir
+
+
+def make_output_store():
+    return shell_recording.OutputStore(
+        os.path.join(get_state_dir(), "output"))
+
+
+# Keeps a warm executable index across shell instances.
+def make_persistent_executable_index():
+    return shell_complete.ExecutableIndex(
+        os.path.join(get_state_dir(), "executables.cache"))
+
+
 class History(object):
 
     def __init__(self):
-        shell_dir = os.path.expanduser("~/.shell2")
-        try:
-            os.mkdir(shell_dir)
-        except OSError, exn:
-            if exn.errno != errno.EEXIST:
-                raise
-        db_path = os.path.join(shell_dir, "history.sqlite")
+        db_path = os.path.join(get_state_dir(), "history.sqlite")
         is_new = not os.path.exists(db_path)
+        self._db_path = db_path
         self.sqldb = sqlite3.connect(db_path)
         # Doing fsync() for every command is too slow.
         self.sqldb.execute("PRAGMA synchronous = OFF")
@@ -548,6 +929,102 @@ class History(object):
             self.sqldb.execute("""
 CREATE TABLE history (time, command, cwd_path, cwd_dev, cwd_ino)
 """)
+        # Databases created by older versions lack this index.
+        self.sqldb.execute("""
+CREATE INDEX IF NOT EXISTS history_cwd ON history (cwd_dev, cwd_ino)
+""")
+        # dir_score is a summary of the history table that is kept up
+        # to date by add_command(), so that "j" does not need to
+        # aggregate over the whole history.
+        if not self._has_table("dir_score"):
+            self.sqldb.execute("""
+CREATE TABLE dir_score (cwd_path PRIMARY KEY, visits, last_visit)
+""")
+            self.rebuild_dir_scores()
+        self._suggestions = None
+        self._usage_counts = None
+        self._pending_suggestions = None
+        # Incremented when the suggestions are discarded, so that a
+        # load that was already running is ignored when it finishes.
+        self._suggestion_generation = 0
+        self._recall_cache = None
+        # High-water mark for rows we have seen, including rows added
+        # by other processes sharing the database.
+        self._last_rowid = self._get_max_rowid()
+        self._data_version = self._get_data_version()
+
+    def _get_max_rowid(self):
+        return self.sqldb.execute(
+            "SELECT MAX(rowid) FROM history").fetchone()[0] or 0
+
+    def _get_data_version(self):
+        # data_version changes whenever another connection commits to
+        # the database.  Older versions of sqlite return no rows.
+        row = self.sqldb.execute("PRAGMA data_version").fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    # Picks up commands added by other shell processes.  This is
+    # intended to be called whenever a prompt is shown, so in the
+    # common case of nothing having changed it costs one PRAGMA.
+    def poll(self):
+        data_version = self._get_data_version()
+        if data_version is None or data_version != self._data_version:
+            self._data_version = data_version
+            self._read_new_rows()
+
+    def _read_new_rows(self):
+        max_rowid = self._get_max_rowid()
+        if max_rowid == self._last_rowid:
+            return
+        self._recall_cache = None
+        if max_rowid - self._last_rowid > SUGGESTION_LOAD_LIMIT:
+            # Probably a bulk import.  Reloading the suggestions from
+            # scratch is cheaper than applying every row.
+            self._suggestions = None
+            self._usage_counts = None
+            self._pending_suggestions = None
+            self._suggestion_generation += 1
+            self._last_rowid = max_rowid
+            return
+        cursor = self.sqldb.execute("""
+SELECT rowid, command, cwd_dev, cwd_ino,
+    COALESCE(CAST(strftime('%s', time) AS INTEGER), 0)
+FROM history WHERE rowid > ? AND rowid <= ? ORDER BY rowid
+""", (self._last_rowid, max_rowid))
+        for rowid, command, cwd_dev, cwd_ino, when in cursor:
+            self._add_suggestion(command, (cwd_dev, cwd_ino), when)
+        self._last_rowid = max_rowid
+
+    def _has_table(self, name):
+        cursor = self.sqldb.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,))
+        return cursor.fetchone() is not None
+
+    def rebuild_dir_scores(self):
+        self.sqldb.execute("DELETE FROM dir_score")
+        self.sqldb.execute("""
+INSERT INTO dir_score (cwd_path, visits, last_visit)
+SELECT cwd_path, COUNT(*), MAX(CAST(strftime('%s', time) AS INTEGER))
+FROM history WHERE cwd_path != '' GROUP BY cwd_path
+""")
+        self.sqldb.commit()
+
+    def _add_dir_visit(self, cwd_path):
+        if cwd_path == "":
+            return
+        cursor = self.sqldb.execute("""
+UPDATE dir_score SET visits = visits + 1,
+    last_visit = CAST(strftime('%s', 'now') AS INTEGER)
+WHERE cwd_path = ?
+""", (cwd_path,))
+        if cursor.rowcount == 0:
+            self.sqldb.execute("""
+INSERT INTO dir_score (cwd_path, visits, last_visit)
+VALUES (?, 1, CAST(strftime('%s', 'now') AS INTEGER))
+""", (cwd_path,))
 
     def add_command(self, line, cwd):
         try:
@@ -556,11 +1033,157 @@ CREATE TABLE history (time, command, cwd_path, cwd_dev, cwd_ino)
             cwd_path = ""
         cwd_fd = cwd.get_cwd_fd()
         cwd_stat = os.fstat(cwd_fd.fileno())
-        self.sqldb.execute("""
+        cursor = self.sqldb.execute("""
 INSERT INTO history (time, command, cwd_path, cwd_dev, cwd_ino)
 VALUES (datetime('now'), ?, ?, ?, ?)
 """, (line, cwd_path, cwd_stat.st_dev, cwd_stat.st_ino))
+        self._add_dir_visit(cwd_path)
         self.sqldb.commit()
+        self._read_new_rows()
+        return cursor.lastrowid
+
+    # Returns (rowid, command) pairs for the most recent commands,
+    # oldest first.
+    def get_recent(self, count):
+        rows = self.sqldb.execute(
+            "SELECT rowid, command FROM history ORDER BY rowid DESC LIMIT ?",
+            (count,)).fetchall()
+        rows.reverse()
+        return rows
+
+    def _add_suggestion(self, *args):
+        if self._suggestions is not None:
+            self._suggestions.add(*args)
+            self._usage_counts.add(args[0])
+        elif self._pending_suggestions is not None:
+            self._pending_suggestions.append(args)
+
+    # The suggestion trie and usage counts are loaded in a thread
+    # (with its own database connection, as sqlite connections cannot
+    # be shared between threads) the first time they are needed.
+    # Commands added in the meantime are queued and applied when
+    # loading finishes.
+    def _start_loading_suggestions(self):
+        # Rows after this are passed to _add_suggestion() by
+        # _read_new_rows().
+        max_rowid = self._last_rowid
+        generation = self._suggestion_generation
+        self._pending_suggestions = []
+
+        def in_thread():
+            trie = shell_suggest.SuggestionTrie()
+            usage_counts = shell_suggest.UsageCounts()
+            now = time.time()
+            sqldb = sqlite3.connect(self._db_path)
+            try:
+                # Only the commands that the trie would keep are
+                # loaded, with their uses summed for each directory.
+                sqldb.create_function(
+                    "use_weight", 1,
+                    functools.partial(shell_suggest.get_use_weight, now))
+                sqldb.execute("""
+CREATE TEMP TABLE recent AS
+SELECT command, cwd_dev, cwd_ino,
+    use_weight(COALESCE(CAST(strftime('%s', time) AS INTEGER), 0)) AS weight
+FROM history WHERE rowid <= ? ORDER BY rowid DESC LIMIT ?
+""", (max_rowid, SUGGESTION_LOAD_LIMIT))
+                cursor = sqldb.execute("""
+SELECT command, cwd_dev, cwd_ino, COUNT(*), SUM(weight) FROM recent
+WHERE command IN (SELECT command FROM recent GROUP BY command
+                  ORDER BY SUM(weight) DESC LIMIT ?)
+GROUP BY command, cwd_dev, cwd_ino
+""", (shell_suggest.MAX_ENTRIES,))
+                for command, cwd_dev, cwd_ino, count, weight in cursor:
+                    trie.add_uses(command, (cwd_dev, cwd_ino), count,
+                                  shell_suggest.weight_to_score(now, weight))
+                cursor = sqldb.execute(
+                    "SELECT command, COUNT(*) FROM recent GROUP BY command")
+                for command, count in cursor:
+                    usage_counts.add(command, count)
+            finally:
+                sqldb.close()
+            gobject.idle_add(lambda: self._finish_loading_suggestions(
+                    generation, trie, usage_counts))
+
+        thread = threading.Thread(target=in_thread)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _finish_loading_suggestions(self, generation, trie, usage_counts):
+        if generation != self._suggestion_generation:
+            # The history changed too much while we were loading.  The
+            # next call to suggest() starts loading it again.
+            return False
+        for args in self._pending_suggestions:
+            trie.add(*args)
+            usage_counts.add(args[0])
+        self._pending_suggestions = None
+        self._suggestions = trie
+        self._usage_counts = usage_counts
+        return False
+
+    def suggest(self, cwd, prefix):
+        if self._suggestions is None:
+            if self._pending_suggestions is None:
+                self._start_loading_suggestions()
+            return None
+        cwd_fd = cwd.get_cwd_fd()
+        cwd_stat = os.fstat(cwd_fd.fileno())
+        return self._suggestions.suggest(prefix,
+                                         (cwd_stat.st_dev, cwd_stat.st_ino))
+
+    # Called from completion worker threads, so this only reads the
+    # counts, which are loaded by suggest().
+    def get_usage_count(self, name):
+        if self._usage_counts is None:
+            return 0
+        return self._usage_counts.get(name)
+
+    # Returns directory pathnames containing all the given fragments
+    # in order, best match first.  The table has one row per
+    # directory, so scanning it is cheap regardless of the size of
+    # the history.
+    def find_directories(self, fragments):
+        pattern = "%%%s%%" % "%".join(like_escape(fragment)
+                                      for fragment in fragments)
+        weight_sql = "CASE %s ELSE %s END" % (
+            " ".join("WHEN :now - last_visit < %i THEN %s" % pair
+                     for pair in FRECENCY_WEIGHTS),
+            FRECENCY_DEFAULT_WEIGHT)
+        cursor = self.sqldb.execute("""
+SELECT cwd_path FROM dir_score WHERE cwd_path LIKE :pattern ESCAPE '\\'
+ORDER BY visits * (%s) DESC
+""" % weight_sql, {"pattern": pattern, "now": int(time.time())})
+        return [path for (path,) in cursor]
+
+    # Returns commands in the order used by pyrepl's history list, so
+    # the most recent command comes last.  Commands that were run in
+    # the current directory are put after all others so that Up
+    # reaches them first.  The directory is matched by inode rather
+    # than by pathname so that renames and symlinks are handled.
+    # Both queries are satisfied by walking an index backwards, so
+    # this is cheap enough to do for every prompt.
+    def get_recall_list(self, cwd):
+        # Keep a reference to the FD wrapper so that it is not closed
+        # before fstat() is called.
+        cwd_fd = cwd.get_cwd_fd()
+        cwd_stat = os.fstat(cwd_fd.fileno())
+        key = (cwd_stat.st_dev, cwd_stat.st_ino, self._last_rowid)
+        if self._recall_cache is not None and self._recall_cache[0] == key:
+            # Return a copy because pyrepl modifies its history list.
+            return list(self._recall_cache[1])
+        local = unique(command for (command,) in self.sqldb.execute("""
+SELECT command FROM history WHERE cwd_dev = ? AND cwd_ino = ?
+ORDER BY rowid DESC LIMIT ?
+""", (cwd_stat.st_dev, cwd_stat.st_ino, RECALL_LIMIT)))
+        local_set = set(local)
+        others = unique(command for (command,) in self.sqldb.execute("""
+SELECT command FROM history ORDER BY rowid DESC LIMIT ?
+""", (RECALL_LIMIT,)) if command not in local_set)
+        commands = local + others
+        commands.reverse()
+        self._recall_cache = (key, commands)
+        return list(commands)
 
 
 class Shell(object):
@@ -575,20 +1198,59 @@ class Shell(object):
                 "cwd_fd": self.real_cwd.get_cwd_fd(),
                 "cwd": self.real_cwd}
 
+    # These return the command's history ID, or None.
     def run_command(self, line, fds):
-        self.history.add_command(line, self.cwd)
+        history_id = self.history.add_command(line, self.cwd)
         run_command(self.job_spawner, self.launcher, line, self._make_spec(fds))
+        return history_id
 
     def run_job_command(self, line, fds, job_spawner):
-        self.history.add_command(line, self.cwd)
+        history_id = self.history.add_command(line, self.cwd)
         run_command(job_spawner, self.launcher, line, self._make_spec(fds))
+        return history_id
+
+
+# Repeated Tab presses on an unchanged line within this time reuse
+# the previous matches.
+COMPLETION_CACHE_TIMEOUT = 5 # seconds
+
+
+# readline has a weird interface to the completer: it asks for one
+# match at a time, by index, until it gets None.  This computes the
+# matches once per completion session and hands them out from a list,
+# pulling them from the completer's iterator only as they are needed.
+class CompletionCache(object):
+
+    def __init__(self, completer, get_time=time.time):
+        self._completer = completer
+        self._get_time = get_time
+        self._key = None
+        self._last_used = None
+        self._matches = []
+        self._match_iter = iter([])
+
+    def get_match(self, line, begidx, string, index):
+        key = (line, begidx, string)
+        now = self._get_time()
+        if (key != self._key or
+            (index == 0 and now > self._last_used + COMPLETION_CACHE_TIMEOUT)):
+            self._key = key
+            self._matches = []
+            self._match_iter = iter(self._completer(line[:begidx], string))
+        self._last_used = now
+        while len(self._matches) <= index:
+            try:
+                self._matches.append(self._match_iter.next())
+            except StopIteration:
+                return None
+        return self._matches[index]
 
 
 class ReadlineReader(object):
 
     def __init__(self, get_prompt, completer):
         self._get_prompt = get_prompt
-        self._completer = completer
+        self._completions = CompletionCache(completer)
         # Don't import readline until we actually need it, because it
         # has the side effect of setting the environment variables
         # LINES and COLUMNS.  When these are set wrongly (with the
@@ -609,32 +1271,32 @@ class ReadlineReader(object):
 
     def _readline_complete_wrapper(self, string, index):
         try:
-            # readline has a weird interface to the completer.  We end up
-            # recomputing the matches for each match, so it can take
-            # O(n^2) time overall.  We could cache but it's not worth the
-            # bother.
             import readline
-            context = readline.get_line_buffer()[:readline.get_begidx()]
-            matches = list(self._completer(context, string))
-            if index < len(matches):
-                return matches[index]
-            else:
-                return None
+            return self._completions.get_match(
+                readline.get_line_buffer(), readline.get_begidx(), string,
+                index)
         except:
             # The readline wrapper swallows any exception so we need to
             # print it if it is to be reported.
             traceback.print_exc()
 
 
-def interactive_main():
-    shell = Shell({"history": History()})
+def interactive_main(fuzzy_completion=False):
+    shell = Shell({"history": History(),
+                   "output_store": make_output_store(),
+                   "executable_index": make_persistent_executable_index(),
+                   "fuzzy_completion": fuzzy_completion})
     fds = {FILENO_STDIN: sys.stdin,
            FILENO_STDOUT: sys.stdout,
            FILENO_STDERR: sys.stderr}
     signal.signal(signal.SIGINT, signal.SIG_IGN)
     try:
         import shell_pyrepl
-        reader = shell_pyrepl.make_reader(shell.get_prompt, shell.completer)
+        reader = shell_pyrepl.make_reader(shell.get_prompt, shell.completer,
+                                          shell.get_recall_list,
+                                          shell.get_suggestion,
+                                          shell.stream_completer)
+        shell.add_prompt_update_handler(reader.redraw_prompt)
         print "using pyrepl"
     except ImportError:
         reader = ReadlineReader(shell.get_prompt, shell.completer)
@@ -644,6 +1306,7 @@ def interactive_main():
     def read_input():
         shell.job_controller.shell_to_foreground()
         shell.job_controller.print_messages()
+        shell.history.poll()
         if os.environ.get("TERM") == "xterm":
             sys.stdout.write("\x1b]2;%s\x07" % shell.get_title())
             sys.stdout.flush()
@@ -669,9 +1332,11 @@ def interactive_main():
 def main():
     parser = optparse.OptionParser()
     parser.add_option("-c", dest="command")
+    parser.add_option("--fuzzy-completion", dest="fuzzy_completion",
+                      action="store_true", default=False)
     options, args = parser.parse_args()
     if options.command is None:
-        interactive_main()
+        interactive_main(options.fuzzy_completion)
     else:
         fds = {FILENO_STDIN: sys.stdin,
                FILENO_STDOUT: sys.stdout,
@@ -0,0 +1,538 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Indexes used to speed up completion.
+
+import bisect
+import itertools
+import marshal
+import os
+import re
+import subprocess
+import threading
+import time
+
+try:
+    # Gives us d_type, so that we can tell directories apart without
+    # stat()ing every entry.
+    import scandir
+except ImportError:
+    scandir = None
+
+
+# A directory modified within this many seconds of being listed might
+# be modified again without its mtime changing, so we don't cache
+# such listings.  This is the same trick that git uses for its index.
+RACY_INTERVAL = 2 # seconds
+
+# Number of directory listings kept by DirectoryCache.
+MAX_CACHED_DIRS = 100
+
+# Commands further than this edit distance from a mistyped command
+# are not suggested.
+MAX_CORRECTION_DISTANCE = 2
+
+# Branches can be added without changing the mtimes that GitRefIndex
+# checks (e.g. "feature/foo" when "feature/" already exists), so
+# listings are also re-read after this long.
+GIT_REFS_TIMEOUT = 60 # seconds
+
+
+def prefix_range(sorted_names, prefix):
+    start = bisect.bisect_left(sorted_names, prefix)
+    end = start
+    while end < len(sorted_names) and sorted_names[end].startswith(prefix):
+        end += 1
+    return start, end
+
+
+def names_with_prefix(sorted_names, prefix):
+    start, end = prefix_range(sorted_names, prefix)
+    return sorted_names[start:end]
+
+
+# Fuzzy matching is done by running one regular expression over all
+# the names, each preceded by a NUL (which cannot appear in
+# filenames), rather than looping over the names in Python.
+def join_names(names):
+    if len(names) == 0:
+        return ""
+    return "\0" + "\0".join(names)
+
+
+def fuzzy_filter(joined_names, string):
+    # Each gap excludes the character that follows it, so the regular
+    # expression never needs to backtrack.
+    pattern = "".join("[^\0%s]*%s" % (re.escape(char), re.escape(char))
+                      for char in string)
+    if not string.startswith("."):
+        # Hidden files are only matched explicitly.
+        pattern = "(?!\\.)" + pattern
+    return re.findall("\0(%s[^\0]*)" % pattern, joined_names)
+
+
+# Tables for str.translate().
+ALL_CHARS = "".join(chr(index) for index in xrange(256))
+# Makes a string of "0" or "1" for each name into a sequence of bytes
+# that are false or true.
+BIT_TABLE = ALL_CHARS.replace("0", "\0").replace("1", "\1")
+
+
+# An index for fuzzy matching over a fixed set of names, such as a
+# directory listing, so that matching doesn't need to look at every
+# name.  For each character, it has a bitmask of the names containing
+# that character, computed the first time the character is used.
+# Only names in the intersection of the masks for the string's
+# characters can match, and the regular expression is only run over
+# those.  Building a mask and selecting the names are done with
+# string operations, which are much faster than a loop in Python.
+class FuzzyIndex(object):
+
+    def __init__(self, names):
+        self.names = names
+        self._joined = join_names(names)
+        self._masks = {}
+
+    def _get_mask(self, char):
+        mask = self._masks.get(char)
+        if mask is None:
+            # Keep only the NULs and this character, as \1, leaving
+            # one NUL per name followed by the occurrences in it.
+            index = ord(char)
+            kept = self._joined.translate(
+                ALL_CHARS[:index] + "\1" + ALL_CHARS[index + 1:],
+                ALL_CHARS[1:index] + ALL_CHARS[index + 1:])
+            bits = (kept.replace("\0\1", "1").translate(None, "\1")
+                    .replace("\0", "0"))
+            # The extra leading 1 stops leading zeros being lost.
+            mask = int("1" + bits, 2)
+            self._masks[char] = mask
+        return mask
+
+    # Returns the names that contain the string's characters in
+    # order, in the same order as self.names.
+    def filter(self, string):
+        if "\0" in string:
+            return []
+        mask = (1 << (len(self.names) + 1)) - 1
+        for char in set(string):
+            mask &= self._get_mask(char)
+        selectors = bytearray(bin(mask)[3:].translate(BIT_TABLE))
+        candidates = list(itertools.compress(self.names, selectors))
+        return fuzzy_filter(join_names(candidates), string)
+
+
+def leaf_name(name):
+    return os.path.basename(name.rstrip("/"))
+
+
+# Orders fuzzy matches with those containing the string as a prefix
+# or substring first, then by how often they appear in the history,
+# then shortest first.  Only the last pathname components are
+# compared.  The sort keys are built with list comprehensions rather
+# than a key function, which would be called for every name.
+def rank_fuzzy_matches(names, string, get_usage_count=None):
+    string = leaf_name(string)
+    leaves = [name.rstrip("/").rsplit("/", 1)[-1] for name in names]
+    qualities = [-2 if leaf.startswith(string) else -(string in leaf)
+                 for leaf in leaves]
+    if get_usage_count is None:
+        counts = [0] * len(names)
+    else:
+        counts = [-count for count in map(get_usage_count, leaves)]
+    keys = zip(qualities, counts, map(len, leaves), names)
+    keys.sort()
+    return [key[3] for key in keys]
+
+
+def list_executables(dir_path):
+    names = []
+    for leaf in os.listdir(dir_path):
+        try:
+            st = os.stat(os.path.join(dir_path, leaf))
+        except OSError:
+            pass
+        else:
+            if st.st_mode & 0111 != 0:
+                names.append(leaf)
+    names.sort()
+    return names
+
+
+# Returns True if execvp() would find the command in path.  This only
+# stats the candidates, so it is much cheaper than listing the
+# directories.
+def is_on_path(path, command):
+    if "/" in command:
+        return True
+    for dir_path in path.split(":"):
+        filename = os.path.join(dir_path, command)
+        if os.access(filename, os.X_OK) and not os.path.isdir(filename):
+            return True
+    return False
+
+
+class ExecutableIndex(object):
+
+    # Cache file format version.
+    VERSION = 1
+
+    def __init__(self, cache_file=None):
+        self._cache_file = cache_file
+        # Maps directory pathname to (mtime, sorted executable names).
+        self._dirs = {}
+        # Maps directory pathname to (names, FuzzyIndex).  get_names()
+        # returns the same list until the directory changes.
+        self._fuzzy_indexes = {}
+        self._dirty = False
+        # Completion may run in several worker threads at once.
+        self._lock = threading.Lock()
+        if cache_file is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            fh = open(self._cache_file, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                version, dirs = marshal.load(fh)
+            except (EOFError, ValueError, TypeError):
+                return
+        finally:
+            fh.close()
+        if version == self.VERSION:
+            self._dirs = dirs
+
+    def save(self):
+        self._lock.acquire()
+        try:
+            if self._cache_file is None or not self._dirty:
+                return
+            temp_file = "%s.%i" % (self._cache_file, os.getpid())
+            fh = open(temp_file, "wb")
+            try:
+                marshal.dump((self.VERSION, self._dirs), fh)
+            finally:
+                fh.close()
+            os.rename(temp_file, self._cache_file)
+            self._dirty = False
+        finally:
+            self._lock.release()
+
+    def get_names(self, dir_path):
+        # Relative directories in PATH are relative to the cwd, so
+        # they cannot be cached by pathname.  Nor can pathnames that
+        # refer to a directory via a file descriptor.
+        if not os.path.isabs(dir_path) or dir_path.startswith("/proc/self/"):
+            try:
+                return list_executables(dir_path + "/")
+            except OSError:
+                return []
+        try:
+            st = os.stat(dir_path)
+        except OSError:
+            return []
+        cached = self._dirs.get(dir_path)
+        if cached is not None and cached[0] == st.st_mtime:
+            return cached[1]
+        try:
+            names = list_executables(dir_path)
+        except OSError:
+            return []
+        if time.time() - st.st_mtime > RACY_INTERVAL:
+            self._lock.acquire()
+            try:
+                self._dirs[dir_path] = (st.st_mtime, names)
+                self._dirty = True
+            finally:
+                self._lock.release()
+        return names
+
+    def complete(self, path, prefix):
+        for dir_path in path.split(":"):
+            for name in names_with_prefix(self.get_names(dir_path), prefix):
+                yield name
+        self.save()
+
+    def _get_fuzzy_index(self, dir_path):
+        names = self.get_names(dir_path)
+        cached = self._fuzzy_indexes.get(dir_path)
+        if cached is not None and cached[0] is names:
+            return cached[1]
+        fuzzy_index = FuzzyIndex(names)
+        self._fuzzy_indexes[dir_path] = (names, fuzzy_index)
+        return fuzzy_index
+
+    def fuzzy_complete(self, path, string):
+        names = []
+        for dir_path in path.split(":"):
+            names.extend(self._get_fuzzy_index(dir_path).filter(string))
+        self.save()
+        return names
+
+
+# Returns the sorted names in a directory, and for each one True if it
+# is a directory, False if it is not, or None if we would have to
+# follow a symlink to find out.
+def list_directory(dir_path):
+    entries = []
+    if scandir is not None:
+        # scandir only calls lstat() itself when d_type is unknown.
+        for entry in scandir.scandir(dir_path):
+            if entry.is_symlink():
+                entries.append((entry.name, None))
+            else:
+                entries.append((entry.name,
+                                entry.is_dir(follow_symlinks=False)))
+    else:
+        for leaf in os.listdir(dir_path):
+            entries.append((leaf, None))
+    entries.sort()
+    return [name for name, is_dir in entries], \
+        [is_dir for name, is_dir in entries]
+
+
+class DirectoryListing(object):
+
+    def __init__(self, mtime, names, is_dirs):
+        self.mtime = mtime
+        self.names = names
+        self.fuzzy_index = FuzzyIndex(names)
+        self._is_dirs = is_dirs
+
+    def is_dir(self, dir_path, index):
+        is_dir = self._is_dirs[index]
+        if is_dir is None:
+            is_dir = os.path.isdir(os.path.join(dir_path, self.names[index]))
+        return is_dir
+
+
+class DirectoryCache(object):
+
+    def __init__(self, max_dirs=MAX_CACHED_DIRS):
+        self._max_dirs = max_dirs
+        # Maps (st_dev, st_ino) to DirectoryListings.  Relative
+        # pathnames depend on the cwd, so we don't key by pathname.
+        self._dirs = {}
+        self._lock = threading.Lock()
+
+    def get_listing(self, dir_path):
+        st = os.stat(dir_path)
+        key = (st.st_dev, st.st_ino)
+        listing = self._dirs.get(key)
+        if listing is not None and listing.mtime == st.st_mtime:
+            return listing
+        listing = DirectoryListing(st.st_mtime, *list_directory(dir_path))
+        if time.time() - st.st_mtime > RACY_INTERVAL:
+            self._lock.acquire()
+            try:
+                if len(self._dirs) >= self._max_dirs:
+                    self._dirs.clear()
+                self._dirs[key] = listing
+            finally:
+                self._lock.release()
+        return listing
+
+    # Yields (leaf name, is directory) pairs.  Only entries that match
+    # the prefix and whose type is not known from d_type get stat()ed.
+    def complete(self, dir_path, prefix):
+        listing = self.get_listing(dir_path or ".")
+        start, end = prefix_range(listing.names, prefix)
+        for index in xrange(start, end):
+            yield listing.names[index], listing.is_dir(dir_path, index)
+
+    def fuzzy_complete(self, dir_path, string):
+        listing = self.get_listing(dir_path or ".")
+        for name in listing.fuzzy_index.filter(string):
+            index = bisect.bisect_left(listing.names, name)
+            yield name, listing.is_dir(dir_path, index)
+
+
+# Optimal string alignment distance: the number of insertions,
+# deletions, substitutions and transpositions of adjacent characters
+# needed to turn one string into the other.
+def edit_distance(string1, string2):
+    prev_row = None
+    row = range(len(string2) + 1)
+    for i, char1 in enumerate(string1):
+        prev_prev_row, prev_row = prev_row, row
+        row = [i + 1]
+        for j, char2 in enumerate(string2):
+            cost = min(prev_row[j + 1] + 1, row[j] + 1,
+                       prev_row[j] + (char1 != char2))
+            if (i > 0 and j > 0 and char1 == string2[j - 1] and
+                string1[i - 1] == char2):
+                cost = min(cost, prev_prev_row[j - 1] + 1)
+            row.append(cost)
+    return row[-1]
+
+
+def deletions(string):
+    return set(string[:i] + string[i+1:] for i in xrange(len(string)))
+
+
+# An index for finding names near a mistyped string, in the style of
+# a symmetric deletion spelling corrector.  Each name is stored under
+# itself and every string formed by deleting one character, and a
+# query looks up the strings formed by deleting up to two characters.
+# This finds every name within edit distance one, and most within
+# distance two, with a few dozen dict lookups and no per-name work.  A
+# BK-tree would instead compute the edit distance in Python for a
+# sizeable fraction of the names.
+class TypoIndex(object):
+
+    def __init__(self, names):
+        self._index = {}
+        for name in names:
+            for key in deletions(name) | set([name]):
+                self._index.setdefault(key, []).append(name)
+
+    def find_candidates(self, string):
+        keys = set([string])
+        for deleted in deletions(string):
+            keys.add(deleted)
+            keys.update(deletions(deleted))
+        candidates = set()
+        for key in keys:
+            candidates.update(self._index.get(key, ()))
+        return candidates
+
+
+# Suggests corrections for commands that are not in PATH.
+class CommandCorrector(object):
+
+    def __init__(self, executable_index):
+        self._executable_index = executable_index
+        # Maps directory pathname to (names, TypoIndex).  The
+        # ExecutableIndex returns the same list for a directory until
+        # it changes, so only changed directories are re-indexed.
+        self._dirs = {}
+
+    def _get_typo_index(self, dir_path, names):
+        cached = self._dirs.get(dir_path)
+        if cached is not None and cached[0] is names:
+            return cached[1]
+        typo_index = TypoIndex(names)
+        self._dirs[dir_path] = (names, typo_index)
+        return typo_index
+
+    # Returns a list of the nearest names, or an empty list if the
+    # command exists.
+    def suggest(self, path, command, extra_names=(), max_results=3):
+        if "/" in command:
+            return []
+        candidates = set()
+        for dir_path in path.split(":"):
+            names = self._executable_index.get_names(dir_path)
+            index = bisect.bisect_left(names, command)
+            if index < len(names) and names[index] == command:
+                return []
+            candidates.update(
+                self._get_typo_index(dir_path, names).find_candidates(command))
+        candidates.update(extra_names)
+        scored = []
+        for name in candidates:
+            distance = edit_distance(command, name)
+            if distance <= MAX_CORRECTION_DISTANCE:
+                scored.append((distance, name))
+        scored.sort()
+        return [name for distance, name in scored[:max_results]]
+
+
+# Returns the .git directory of the repository containing the given
+# directory, or None.
+def find_git_dir(dir_path):
+    while True:
+        git_path = os.path.join(dir_path, ".git")
+        if os.path.isdir(git_path):
+            return git_path
+        if os.path.isfile(git_path):
+            # Worktrees and submodules have a file pointing elsewhere.
+            fh = open(git_path, "r")
+            try:
+                line = fh.readline().strip()
+            finally:
+                fh.close()
+            if line.startswith("gitdir: "):
+                return os.path.join(dir_path, line[len("gitdir: "):])
+            return None
+        parent = os.path.dirname(dir_path)
+        if parent == dir_path:
+            return None
+        dir_path = parent
+
+
+def get_mtime(pathname):
+    try:
+        return os.stat(pathname).st_mtime
+    except OSError:
+        return None
+
+
+# Caches the output of "git for-each-ref" for each repository.
+class GitRefIndex(object):
+
+    def __init__(self, get_time=time.time):
+        self._get_time = get_time
+        # Maps .git pathname to (stamp, time, sorted ref names).
+        self._repos = {}
+        self._lock = threading.Lock()
+
+    def _get_stamp(self, git_dir):
+        return tuple(get_mtime(os.path.join(git_dir, leaf))
+                     for leaf in ("HEAD", "packed-refs", "refs/heads",
+                                  "refs/remotes", "refs/tags"))
+
+    def get_refs(self, git_dir):
+        stamp = self._get_stamp(git_dir)
+        now = self._get_time()
+        cached = self._repos.get(git_dir)
+        if (cached is not None and cached[0] == stamp and
+            now - cached[1] < GIT_REFS_TIMEOUT):
+            return cached[2]
+        devnull = open(os.devnull, "w")
+        try:
+            try:
+                proc = subprocess.Popen(
+                    ["git", "--git-dir", git_dir, "for-each-ref",
+                     "--format=%(refname:short)",
+                     "refs/heads", "refs/remotes", "refs/tags"],
+                    stdout=subprocess.PIPE, stderr=devnull)
+            except OSError:
+                # git is not installed.
+                return []
+            output = proc.communicate()[0]
+        finally:
+            devnull.close()
+        if proc.returncode != 0:
+            return []
+        refs = sorted(set(output.split()))
+        self._lock.acquire()
+        try:
+            self._repos[git_dir] = (stamp, now, refs)
+        finally:
+            self._lock.release()
+        return refs
+
+    def complete(self, dir_path, prefix):
+        git_dir = find_git_dir(dir_path)
+        if git_dir is None:
+            return []
+        return names_with_prefix(self.get_refs(git_dir), prefix)
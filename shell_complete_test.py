@@ -0,0 +1,202 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+import os
+import subprocess
+import unittest
+
+import shell_complete
+import tempdir_test
+
+
+def make_executable(filename):
+    fh = open(filename, "w")
+    fh.close()
+    os.chmod(filename, 0755)
+
+
+class BinDirTestCase(tempdir_test.TempDirTestCase):
+
+    def make_bin_dir(self, names):
+        bin_dir = self.make_temp_dir()
+        for name in names:
+            make_executable(os.path.join(bin_dir, name))
+        # Make the listing old enough to be cached.
+        os.utime(bin_dir, (1000, 1000))
+        return bin_dir
+
+
+class ExecutableIndexTest(BinDirTestCase):
+
+    def test_prefix_lookup(self):
+        bin_dir = self.make_bin_dir(["aa", "ab", "b"])
+        fh = open(os.path.join(bin_dir, "ac"), "w")
+        fh.close()
+        index = shell_complete.ExecutableIndex()
+        self.assertEquals(list(index.complete(bin_dir, "a")), ["aa", "ab"])
+        self.assertEquals(list(index.complete(bin_dir, "")), ["aa", "ab", "b"])
+        self.assertEquals(list(index.complete(bin_dir, "c")), [])
+
+    def test_invalidation_by_mtime(self):
+        bin_dir = self.make_bin_dir(["prog1"])
+        index = shell_complete.ExecutableIndex()
+        self.assertEquals(list(index.complete(bin_dir, "")), ["prog1"])
+        make_executable(os.path.join(bin_dir, "prog2"))
+        os.utime(bin_dir, (2000, 2000))
+        self.assertEquals(list(index.complete(bin_dir, "")),
+                          ["prog1", "prog2"])
+
+    def test_persisting(self):
+        bin_dir = self.make_bin_dir(["prog1"])
+        cache_file = os.path.join(self.make_temp_dir(), "cache")
+        index = shell_complete.ExecutableIndex(cache_file)
+        self.assertEquals(list(index.complete(bin_dir, "")), ["prog1"])
+        # Change the directory without changing its mtime, so that
+        # we can tell whether the listing came from the cache file.
+        os.unlink(os.path.join(bin_dir, "prog1"))
+        os.utime(bin_dir, (1000, 1000))
+        index = shell_complete.ExecutableIndex(cache_file)
+        self.assertEquals(list(index.complete(bin_dir, "")), ["prog1"])
+
+
+class CommandCorrectorTest(BinDirTestCase):
+
+    def test_edit_distance(self):
+        self.assertEquals(shell_complete.edit_distance("ls", "ls"), 0)
+        self.assertEquals(shell_complete.edit_distance("sl", "ls"), 1)
+        self.assertEquals(shell_complete.edit_distance("grpe", "grep"), 1)
+        self.assertEquals(shell_complete.edit_distance("gerp", "grep"), 1)
+        self.assertEquals(shell_complete.edit_distance("", "abc"), 3)
+        self.assertEquals(shell_complete.edit_distance("kitten", "sitting"), 3)
+
+    def test_suggestions(self):
+        bin_dir = self.make_bin_dir(["grep", "egrep", "git", "gitk", "ls"])
+        corrector = shell_complete.CommandCorrector(
+            shell_complete.ExecutableIndex())
+        self.assertEquals(corrector.suggest(bin_dir, "gerp"), ["grep"])
+        self.assertEquals(corrector.suggest(bin_dir, "gti", ["fg"]),
+                          ["git"])
+        self.assertEquals(corrector.suggest(bin_dir, "gf", ["fg"]), ["fg"])
+        self.assertEquals(corrector.suggest(bin_dir, "git"), [])
+        self.assertEquals(corrector.suggest(bin_dir, "xyzzy"), [])
+
+    def test_is_on_path(self):
+        bin_dir = self.make_bin_dir(["grep"])
+        path = "%s:/nonexistent" % bin_dir
+        self.assertTrue(shell_complete.is_on_path(path, "grep"))
+        self.assertFalse(shell_complete.is_on_path(path, "gerp"))
+        self.assertTrue(shell_complete.is_on_path(path, "./gerp"))
+
+
+class DirectoryCacheTest(tempdir_test.TempDirTestCase):
+
+    def test_prefix_lookup(self):
+        temp_dir = self.make_temp_dir()
+        for name in ["a-file", "b-file"]:
+            fh = open(os.path.join(temp_dir, name), "w")
+            fh.close()
+        os.mkdir(os.path.join(temp_dir, "a-dir"))
+        os.symlink("a-dir", os.path.join(temp_dir, "a-link"))
+        os.symlink("does-not-exist", os.path.join(temp_dir, "a-dangling"))
+        cache = shell_complete.DirectoryCache()
+        self.assertEquals(list(cache.complete(temp_dir + "/", "a-")),
+                          [("a-dangling", False), ("a-dir", True),
+                           ("a-file", False), ("a-link", True)])
+        self.assertEquals(list(cache.complete(temp_dir + "/", "c")), [])
+
+    def test_invalidation_by_mtime(self):
+        temp_dir = self.make_temp_dir()
+        os.utime(temp_dir, (1000, 1000))
+        cache = shell_complete.DirectoryCache()
+        self.assertEquals(list(cache.complete(temp_dir, "")), [])
+        os.mkdir(os.path.join(temp_dir, "subdir"))
+        os.utime(temp_dir, (2000, 2000))
+        self.assertEquals(list(cache.complete(temp_dir, "")),
+                          [("subdir", True)])
+
+
+class FuzzyMatchTest(unittest.TestCase):
+
+    def test_filter(self):
+        joined = shell_complete.join_names(
+            ["Makefile", "make-dist.sh", "setup.py", ".mk"])
+        self.assertEquals(shell_complete.fuzzy_filter(joined, "mk"),
+                          ["make-dist.sh"])
+        self.assertEquals(shell_complete.fuzzy_filter(joined, "ake"),
+                          ["Makefile", "make-dist.sh"])
+        self.assertEquals(shell_complete.fuzzy_filter(joined, ".mk"), [".mk"])
+        self.assertEquals(shell_complete.fuzzy_filter(joined, "[]"), [])
+
+    def test_index(self):
+        names = ["Makefile", "make-dist.sh", "setup.py", ".mk", "a10",
+                 "b01", "[x]"]
+        index = shell_complete.FuzzyIndex(names)
+        joined = shell_complete.join_names(names)
+        for string in ["mk", "ake", ".mk", "", "10", "01", "1", "[]", "x",
+                       "zz"]:
+            self.assertEquals(index.filter(string),
+                              shell_complete.fuzzy_filter(joined, string))
+        self.assertEquals(index.filter("10"), ["a10"])
+        self.assertEquals(index.filter("\0"), [])
+        self.assertEquals(shell_complete.FuzzyIndex([]).filter("a"), [])
+
+    def test_ranking(self):
+        names = ["a-long-xyz", "xyz", "xaybzc", "dir/xyzzy/"]
+        counts = {"xaybzc": 5}
+        self.assertEquals(
+            shell_complete.rank_fuzzy_matches(names, "xyz"),
+            ["xyz", "dir/xyzzy/", "a-long-xyz", "xaybzc"])
+        self.assertEquals(
+            shell_complete.rank_fuzzy_matches(
+                names, "x", lambda name: counts.get(name, 0)),
+            ["xaybzc", "xyz", "dir/xyzzy/", "a-long-xyz"])
+
+
+class GitRefIndexTest(tempdir_test.TempDirTestCase):
+
+    def git(self, repo_dir, *args):
+        subprocess.check_call(
+            ["git", "-c", "user.name=Test", "-c", "user.email=test@test",
+             "--git-dir", os.path.join(repo_dir, ".git")] + list(args),
+            stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))
+
+    def test_branch_completion(self):
+        repo_dir = self.make_temp_dir()
+        self.git(repo_dir, "init")
+        self.git(repo_dir, "commit", "--allow-empty", "-m", "Initial")
+        self.git(repo_dir, "branch", "feature-1")
+        subdir = os.path.join(repo_dir, "subdir")
+        os.mkdir(subdir)
+        heads_dir = os.path.join(repo_dir, ".git", "refs", "heads")
+        os.utime(heads_dir, (1000, 1000))
+        now = [0]
+        index = shell_complete.GitRefIndex(get_time=lambda: now[0])
+        self.assertEquals(list(index.complete(subdir, "feat")), ["feature-1"])
+        # Adding a branch in a new directory under refs/heads need
+        # not change the mtimes we check, so it is picked up after a
+        # timeout.
+        self.git(repo_dir, "branch", "feature-1-dir/sub")
+        os.utime(heads_dir, (1000, 1000))
+        self.assertEquals(list(index.complete(subdir, "feat")), ["feature-1"])
+        now[0] = shell_complete.GIT_REFS_TIMEOUT
+        self.assertEquals(list(index.complete(subdir, "feat")),
+                          ["feature-1", "feature-1-dir/sub"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,10 +17,22 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301 USA.
 
+import sys
+import time
+
 import shell
 
 
-def main():
+USAGE = """\
+Usage:
+  shell_history.py               List the command history
+  shell_history.py merge FILE... Merge history.sqlite or .bash_history files
+"""
+
+SQLITE_HEADER = "SQLite format 3\0"
+
+
+def print_history():
     sqldb = shell.History().sqldb
     cursor = sqldb.execute(
         "SELECT command, time, cwd_path FROM history ORDER BY time")
@@ -29,5 +41,93 @@ def main():
         print "%s [%s]: %s" % (time, cwd, command)
 
 
+def is_sqlite_file(filename):
+    fh = open(filename, "rb")
+    try:
+        return fh.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    finally:
+        fh.close()
+
+
+# Bash records timestamps as "#<seconds>" lines when HISTTIMEFORMAT is
+# set.  Bash does not record the cwd.
+def read_bash_history(filename):
+    timestamp = None
+    for line in open(filename, "r"):
+        line = line.rstrip("\n")
+        if line.startswith("#") and line[1:].isdigit():
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S",
+                                      time.gmtime(int(line[1:])))
+        elif line.strip() != "":
+            yield (timestamp, line.decode("utf-8", "replace"), "", None, None)
+
+
+# Rows are staged in a temporary table and merged with a few
+# set-based statements in one transaction, rather than checking for
+# duplicates row by row.  Rows count as duplicates if they have the
+# same (time, command, cwd_path), since cwd_dev and cwd_ino are not
+# meaningful across machines.
+def merge_history(history, filenames):
+    sqldb = history.sqldb
+    sqldb.execute("""
+CREATE TEMP TABLE import_rows (time, command, cwd_path, cwd_dev, cwd_ino)
+""")
+    try:
+        for filename in filenames:
+            if is_sqlite_file(filename):
+                # sqlite can copy directly between attached databases,
+                # which is faster than passing each row through Python.
+                sqldb.execute("ATTACH DATABASE ? AS source", (filename,))
+                try:
+                    sqldb.execute("""
+INSERT INTO import_rows
+SELECT time, command, cwd_path, cwd_dev, cwd_ino FROM source.history
+""")
+                    sqldb.commit()
+                finally:
+                    sqldb.execute("DETACH DATABASE source")
+            else:
+                sqldb.executemany(
+                    "INSERT INTO import_rows VALUES (?, ?, ?, ?, ?)",
+                    read_bash_history(filename))
+                sqldb.commit()
+        sqldb.execute("""
+CREATE INDEX temp.import_rows_key ON import_rows (time, command, cwd_path)
+""")
+        sqldb.execute("""
+DELETE FROM import_rows WHERE rowid IN (
+    SELECT import_rows.rowid FROM main.history JOIN import_rows
+    ON import_rows.time IS history.time AND
+       import_rows.command IS history.command AND
+       import_rows.cwd_path IS history.cwd_path)
+""")
+        # Insert in time order so that rowid order stays roughly
+        # chronological within the imported rows.
+        cursor = sqldb.execute("""
+INSERT INTO main.history (time, command, cwd_path, cwd_dev, cwd_ino)
+SELECT time, command, cwd_path, cwd_dev, cwd_ino FROM import_rows
+WHERE rowid IN (SELECT MIN(rowid) FROM import_rows
+                GROUP BY time, command, cwd_path)
+ORDER BY time
+""")
+        count = cursor.rowcount
+        sqldb.commit()
+    finally:
+        sqldb.execute("DROP TABLE temp.import_rows")
+    history.rebuild_dir_scores()
+    return count
+
+
+def main(args):
+    if len(args) == 0:
+        print_history()
+    elif args[0] == "merge" and len(args) > 1:
+        count = merge_history(shell.History(), args[1:])
+        print "Added %i commands" % count
+    else:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
@@ -0,0 +1,69 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+import os
+import unittest
+
+import shell
+import shell_history
+import shell_test
+
+
+class MergeTest(shell_test.TestCase):
+
+    def get_commands(self, history):
+        return [command for (command,) in history.sqldb.execute(
+                "SELECT command FROM history ORDER BY rowid")]
+
+    def test_merging_sqlite_history(self):
+        home_dir1 = self.make_temp_dir()
+        home_dir2 = self.make_temp_dir()
+        cwd = shell_test.make_shell().cwd
+        self.patch_env_var("HOME", home_dir1)
+        history1 = shell.History()
+        history1.add_command("echo from-other-machine", cwd)
+        os.environ["HOME"] = home_dir2
+        history2 = shell.History()
+        history2.add_command("echo local", cwd)
+        source = os.path.join(home_dir1, ".shell2", "history.sqlite")
+        self.assertEquals(shell_history.merge_history(history2, [source]), 1)
+        # Merging a second time adds nothing.
+        self.assertEquals(shell_history.merge_history(history2, [source]), 0)
+        self.assertEquals(sorted(self.get_commands(history2)),
+                          ["echo from-other-machine", "echo local"])
+
+    def test_importing_bash_history(self):
+        self.patch_env_var("HOME", self.make_temp_dir())
+        bash_history = os.path.join(self.make_temp_dir(), "bash_history")
+        shell_test.write_file(bash_history,
+                              "ls\n#1250000000\nmake\n#1250000010\nmake\n")
+        history = shell.History()
+        self.assertEquals(
+            shell_history.merge_history(history, [bash_history]), 3)
+        self.assertEquals(
+            shell_history.merge_history(history, [bash_history]), 0)
+        self.assertEquals(
+            list(history.sqldb.execute(
+                    "SELECT time, command FROM history ORDER BY time")),
+            [(None, "ls"),
+             ("2009-08-11 14:13:20", "make"),
+             ("2009-08-11 14:13:30", "make")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,326 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Prompt templates, in the style of Bash's PS1.  Supported escapes:
+#
+#   \u  username            \h  hostname up to the first "."
+#   \H  hostname            \$  "#" if running as root, otherwise "$"
+#   \w  cwd, with ~ for the home directory
+#   \W  last component of the cwd
+#   \t  time as HH:MM:SS    \A  time as HH:MM
+#   \?  exit status of the last command
+#   \j  number of jobs
+#   \E  elapsed time of the last command
+#   \g  git branch, with "*" if there are uncommitted changes
+#   \n  newline             \\  backslash
+#
+# A template is compiled once into a list of segments.  Segments that
+# cannot change during a session are rendered at compile time.  The
+# others depend on a named input, and are only re-rendered when that
+# input's value changes.  Inputs that are slow to compute, such as
+# the git status, are computed in the background by AsyncInput.
+
+import os
+import pwd
+import socket
+import subprocess
+import threading
+import time
+
+import shell_complete
+import shell_event
+import shell_worker
+
+
+# git status is killed if it takes longer than this.
+GIT_STATUS_TIMEOUT = 2 # seconds
+
+# Number of values kept by each AsyncInput.
+MAX_ASYNC_VALUES = 20
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return ""
+    seconds = int(seconds)
+    if seconds < 60:
+        return "%is" % seconds
+    if seconds < 60 * 60:
+        return "%im%02is" % (seconds // 60, seconds % 60)
+    return "%ih%02im" % (seconds // (60 * 60), seconds // 60 % 60)
+
+
+# Replaces all but the last "count" components of the pathname with
+# "...", like Bash's PROMPT_DIRTRIM.
+def trim_path(path, count):
+    if count <= 0:
+        return path
+    parts = path.split("/")
+    # Keep the leading "~" or "" (for "/") in addition to count parts.
+    if len(parts) <= count + 2:
+        return path
+    return "/".join([parts[0], "..."] + parts[-count:])
+
+
+def format_exit_status(status):
+    if status is None:
+        return ""
+    return str(status)
+
+
+def format_vcs_status(status):
+    if status is None:
+        return ""
+    return "(%s)" % status
+
+
+def get_basename(path):
+    if path in ("/", "~"):
+        return path
+    return path.rstrip("/").split("/")[-1]
+
+
+class Segment(object):
+
+    def __init__(self, input_name, render):
+        self.input_name = input_name
+        self._render = render
+        self._last_input = None
+        self._text = None
+
+    def get_text(self, value):
+        if self._text is None or value != self._last_input:
+            self._text = self._render(value)
+            self._last_input = value
+        return self._text
+
+
+# Maps escape characters to (input name, render function) for the
+# segments that can change.
+def get_dynamic_escapes(dirtrim):
+    return {
+        "w": ("cwd", lambda path: trim_path(path, dirtrim)),
+        "W": ("cwd", get_basename),
+        "t": ("time", lambda now: time.strftime("%H:%M:%S",
+                                                time.localtime(now))),
+        "A": ("time", lambda now: time.strftime("%H:%M",
+                                                time.localtime(now))),
+        "?": ("status", format_exit_status),
+        "j": ("jobs", str),
+        "E": ("duration", format_duration),
+        "g": ("vcs", format_vcs_status),
+        }
+
+
+def get_static_escapes():
+    hostname = socket.gethostname()
+    if os.getuid() == 0:
+        dollar = "#"
+    else:
+        dollar = "$"
+    return {"u": pwd.getpwuid(os.getuid()).pw_name,
+            "h": hostname.split(".")[0],
+            "H": hostname,
+            "$": dollar,
+            "n": "\n",
+            "\\": "\\"}
+
+
+# Returns a list of segments, merging adjacent static text into
+# single strings.
+def compile_template(template, dirtrim=0):
+    static = get_static_escapes()
+    dynamic = get_dynamic_escapes(dirtrim)
+    segments = []
+    text = []
+    index = 0
+    while index < len(template):
+        char = template[index]
+        if char == "\\" and index + 1 < len(template):
+            escape = template[index + 1]
+            index += 2
+            if escape in static:
+                text.append(static[escape])
+            elif escape in dynamic:
+                if len(text) > 0:
+                    segments.append("".join(text))
+                    text = []
+                segments.append(Segment(*dynamic[escape]))
+            else:
+                text.append("\\" + escape)
+        else:
+            text.append(char)
+            index += 1
+    if len(text) > 0:
+        segments.append("".join(text))
+    return segments
+
+
+class Prompt(object):
+
+    # get_input maps input names to functions returning their
+    # current values.  Each input is fetched at most once per render,
+    # and only if the template uses it.
+    def __init__(self, template, get_input, dirtrim=0):
+        self._segments = compile_template(template, dirtrim)
+        self._get_input = get_input
+
+    def render(self):
+        values = {}
+        output = []
+        for segment in self._segments:
+            if isinstance(segment, basestring):
+                output.append(segment)
+            else:
+                name = segment.input_name
+                if name not in values:
+                    values[name] = self._get_input[name]()
+                output.append(segment.get_text(values[name]))
+        return "".join(output)
+
+
+# Provides the value of a prompt input that is computed in a worker
+# thread.  get_key() is called for each render, so it must be cheap;
+# it returns None if there is no value.  compute(key) is called in
+# the background, and until its result arrives the last value shown
+# is used.  Update handlers are called when a new value arrives, so
+# that the prompt can be redrawn.
+class AsyncInput(object):
+
+    def __init__(self, get_key, compute, pool=None):
+        self._get_key = get_key
+        self._compute = compute
+        self._pool = pool
+        self._values = {}
+        # Maps keys being computed to the generation they started in.
+        self._pending = {}
+        self._generation = 0
+        self._last_value = None
+        self._on_update = shell_event.EventDistributor()
+        self.add_update_handler = self._on_update.add
+
+    # Discards cached values, e.g. because a command has run.
+    def invalidate(self):
+        self._values.clear()
+        self._generation += 1
+
+    def __call__(self):
+        key = self._get_key()
+        if key is None:
+            self._last_value = None
+        elif key in self._values:
+            self._last_value = self._values[key]
+        elif self._pending.get(key) != self._generation:
+            generation = self._generation
+            self._pending[key] = generation
+            pool = self._pool
+            if pool is None:
+                pool = shell_worker.get_default_pool()
+            pool.call(lambda: self._compute(key),
+                      lambda value: self._set_value(key, generation, value))
+        return self._last_value
+
+    def _set_value(self, key, generation, value):
+        if self._pending.get(key) == generation:
+            del self._pending[key]
+        if generation != self._generation:
+            # Invalidated while we were computing it.
+            return
+        if len(self._values) >= MAX_ASYNC_VALUES:
+            self._values.clear()
+        self._values[key] = value
+        self._on_update.send()
+
+
+# Runs a command, killing it if it takes longer than timeout.  Returns
+# its output, or None if it failed or timed out.
+def get_output_with_timeout(args, cwd, timeout):
+    devnull = open(os.devnull, "r+")
+    try:
+        try:
+            proc = subprocess.Popen(args, cwd=cwd, stdin=devnull,
+                                    stdout=subprocess.PIPE, stderr=devnull)
+        except OSError:
+            return None
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        try:
+            output = proc.communicate()[0]
+        finally:
+            timer.cancel()
+    finally:
+        devnull.close()
+    if proc.returncode != 0:
+        return None
+    return output
+
+
+def parse_git_status(output):
+    lines = output.splitlines()
+    if len(lines) == 0 or not lines[0].startswith("## "):
+        return None
+    branch = lines[0][len("## "):].split("...")[0]
+    for prefix in ("No commits yet on ", "Initial commit on "):
+        if branch.startswith(prefix):
+            branch = branch[len(prefix):]
+    if branch.startswith("HEAD "):
+        branch = "HEAD"
+    if len(lines) > 1:
+        branch += "*"
+    return branch
+
+
+class GitStatus(object):
+
+    def __init__(self, cwd, timeout=GIT_STATUS_TIMEOUT):
+        self._cwd = cwd
+        self._timeout = timeout
+        # Maps cwd (st_dev, st_ino) to (cwd pathname, .git pathname).
+        self._git_dirs = {}
+
+    def invalidate(self):
+        self._git_dirs.clear()
+
+    # The status is cached for each directory until git's index or
+    # HEAD changes.
+    def get_key(self):
+        cwd_fd = self._cwd.get_cwd_fd()
+        st = os.fstat(cwd_fd.fileno())
+        cwd_key = (st.st_dev, st.st_ino)
+        if cwd_key not in self._git_dirs:
+            try:
+                cwd_path = self._cwd.get_cwd()
+            except OSError:
+                return None
+            self._git_dirs[cwd_key] = (
+                cwd_path, shell_complete.find_git_dir(cwd_path))
+        cwd_path, git_dir = self._git_dirs[cwd_key]
+        if git_dir is None:
+            return None
+        return (cwd_key, cwd_path,
+                shell_complete.get_mtime(os.path.join(git_dir, "index")),
+                shell_complete.get_mtime(os.path.join(git_dir, "HEAD")))
+
+    # Called in a worker thread.
+    def compute(self, key):
+        output = get_output_with_timeout(
+            ["git", "status", "--porcelain", "-b", "--untracked-files=no"],
+            key[1], self._timeout)
+        if output is None:
+            return "?"
+        return parse_git_status(output)
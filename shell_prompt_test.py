@@ -0,0 +1,171 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+import os
+import pwd
+import socket
+import unittest
+
+import shell
+import shell_prompt
+import tempdir_test
+
+
+class PromptTest(unittest.TestCase):
+
+    def make_prompt(self, template, inputs, dirtrim=0):
+        calls = []
+        def make_getter(name):
+            def getter():
+                calls.append(name)
+                return inputs[name]
+            return getter
+        get_input = dict((name, make_getter(name)) for name in inputs)
+        return shell_prompt.Prompt(template, get_input, dirtrim), calls
+
+    def test_escapes(self):
+        prompt, calls = self.make_prompt(
+            r"\u:\w:\W:\?:\j:\E:\\:\x\$ ",
+            {"cwd": "~/foo/bar", "status": 1, "jobs": 2, "duration": 75})
+        if os.getuid() == 0:
+            dollar = "#"
+        else:
+            dollar = "$"
+        self.assertEquals(prompt.render(),
+                          "%s:~/foo/bar:bar:1:2:1m15s:\\:\\x%s "
+                          % (pwd.getpwuid(os.getuid()).pw_name, dollar))
+
+    def test_unicode_template(self):
+        prompt, calls = self.make_prompt(u"[\\?] \\w> ",
+                                         {"cwd": "/a", "status": None})
+        self.assertEquals(prompt.render(), "[] /a> ")
+
+    def test_hostname(self):
+        hostname = socket.gethostname()
+        self.assertEquals(shell_prompt.compile_template(r"\h \H"),
+                          ["%s %s" % (hostname.split(".")[0], hostname)])
+
+    def test_inputs_fetched_once_and_only_if_used(self):
+        prompt, calls = self.make_prompt(r"\w \W> ",
+                                         {"cwd": "/a/b", "status": 0})
+        self.assertEquals(prompt.render(), "/a/b b> ")
+        self.assertEquals(calls, ["cwd"])
+
+    def test_static_segments_merged(self):
+        segments = shell_prompt.compile_template(r"\u@\h \w\$ ")
+        self.assertEquals(len(segments), 3)
+        self.assertEquals(segments[1].input_name, "cwd")
+
+    def test_dirtrim(self):
+        prompt, calls = self.make_prompt(r"\w", {"cwd": "~/a/b/c/d"}, 2)
+        self.assertEquals(prompt.render(), "~/.../c/d")
+        self.assertEquals(shell_prompt.trim_path("/a/b/c/d", 2), "/.../c/d")
+        self.assertEquals(shell_prompt.trim_path("/a/b/c", 2), "/a/b/c")
+
+    def test_duration_format(self):
+        self.assertEquals(shell_prompt.format_duration(None), "")
+        self.assertEquals(shell_prompt.format_duration(5.5), "5s")
+        self.assertEquals(shell_prompt.format_duration(3 * 3600 + 120),
+                          "3h02m")
+
+
+class GitStatusTest(tempdir_test.TempDirTestCase):
+
+    def test_key_with_global_cwd(self):
+        temp_dir = os.path.realpath(self.make_temp_dir())
+        os.mkdir(os.path.join(temp_dir, ".git"))
+        # GlobalCwdTracker returns a new FD each time it is asked.
+        status = shell_prompt.GitStatus(shell.GlobalCwdTracker())
+        old_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        try:
+            key = status.get_key()
+        finally:
+            os.chdir(old_cwd)
+        self.assertEquals(key[1], temp_dir)
+
+
+class QueuedPool(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def call(self, func, callback):
+        self.calls.append((func, callback))
+
+    def run_all(self):
+        while len(self.calls) > 0:
+            func, callback = self.calls.pop(0)
+            callback(func())
+
+
+class AsyncInputTest(unittest.TestCase):
+
+    def test_last_value_shown_until_computed(self):
+        pool = QueuedPool()
+        key = ["dir1"]
+        computed = []
+        def compute(key):
+            computed.append(key)
+            return key.upper()
+        async_input = shell_prompt.AsyncInput(lambda: key[0], compute, pool)
+        updates = []
+        async_input.add_update_handler(lambda: updates.append(True))
+        self.assertEquals(async_input(), None)
+        self.assertEquals(async_input(), None)
+        pool.run_all()
+        self.assertEquals(computed, ["dir1"])
+        self.assertEquals(len(updates), 1)
+        self.assertEquals(async_input(), "DIR1")
+        key[0] = "dir2"
+        self.assertEquals(async_input(), "DIR1")
+        pool.run_all()
+        self.assertEquals(async_input(), "DIR2")
+        # Cached values are reused until invalidated.
+        key[0] = "dir1"
+        self.assertEquals(async_input(), "DIR1")
+        self.assertEquals(computed, ["dir1", "dir2"])
+        async_input.invalidate()
+        async_input()
+        pool.run_all()
+        self.assertEquals(computed, ["dir1", "dir2", "dir1"])
+
+    def test_results_discarded_after_invalidation(self):
+        pool = QueuedPool()
+        async_input = shell_prompt.AsyncInput(lambda: "key", lambda key: 1,
+                                              pool)
+        async_input()
+        async_input.invalidate()
+        pool.run_all()
+        self.assertEquals(async_input(), None)
+        pool.run_all()
+        self.assertEquals(async_input(), 1)
+
+    def test_parse_git_status(self):
+        self.assertEquals(shell_prompt.parse_git_status(
+                "## master...origin/master [ahead 1]\n"), "master")
+        self.assertEquals(shell_prompt.parse_git_status(
+                "## topic\n M shell.py\n"), "topic*")
+        self.assertEquals(shell_prompt.parse_git_status(
+                "## No commits yet on master\n"), "master")
+        self.assertEquals(shell_prompt.parse_git_status(
+                "## HEAD (no branch)\n"), "HEAD")
+
+
+if __name__ == "__main__":
+    unittest.main()
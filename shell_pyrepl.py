@@ -16,6 +16,9 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301 USA.
 
+import threading
+import time
+
 import gobject
 
 import pyrepl.commands
@@ -23,18 +26,89 @@ import pyrepl.completing_reader
 import pyrepl.historical_reader
 import pyrepl.unix_console
 
+import shell_worker
+
+
+# How long to block waiting for completions before returning to the
+# main loop and finishing them in the background.
+COMPLETION_WAIT = 0.05 # seconds
+
+# Give up on completions that take longer than this.
+COMPLETION_TIMEOUT = 10 # seconds
+
+# How often to update the display while completing in the background.
+COMPLETION_PROGRESS_INTERVAL = 200 # milliseconds
+
+
+class CompletionCancelled(Exception):
+
+    pass
+
+
+class CompletionRequest(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.matches = []
+        self.ranked = False
+        self.cancelled = False
+        self.waiting = False
+        self.finished = threading.Event()
+        self.start_time = time.time()
+
+    # Called from the worker thread.
+    def add_match(self, match):
+        if self.cancelled:
+            raise CompletionCancelled()
+        self.matches.append(match)
+
+
+class complete(pyrepl.completing_reader.complete):
+
+    # If the completions are not available yet, the reader runs this
+    # command again when they arrive.
+    def do(self):
+        reader = self.reader
+        repeated = reader.last_command_is(self.__class__)
+        if repeated and reader.fuzzy_cycle is not None:
+            reader.next_fuzzy_match()
+        elif reader.completions_ready(repeated):
+            stem = reader.get_stem()
+            completions = reader.get_completions(stem)
+            if (len(completions) > 0 and
+                not completions[0].startswith(stem)):
+                # Fuzzy matches do not extend the stem, so pyrepl's
+                # common prefix logic does not apply.  Instead, each
+                # Tab press replaces the stem with the next match.
+                reader.fuzzy_cycle = (completions, -1)
+                reader.next_fuzzy_match()
+            else:
+                super(complete, self).do()
+
 
 class Reader(pyrepl.historical_reader.HistoricalReader,
              pyrepl.completing_reader.CompletingReader):
 
-    def __init__(self, get_prompt, completer, *args):
+    def __init__(self, get_prompt, completer, console, get_history=None,
+                 get_suggestion=None, stream_completer=None):
         self._get_prompt = get_prompt
         self._completer = completer
-        super(Reader, self).__init__(*args)
+        self._get_history = get_history
+        self._get_suggestion = get_suggestion
+        self._suggestion = ("", "")
+        self._stream_completer = stream_completer
+        self._completion_request = None
+        # (ranked matches, index of the one inserted) while cycling
+        # through fuzzy completions.
+        self.fuzzy_cycle = None
+        self._completions_memo = None
+        self._active = False
+        super(Reader, self).__init__(console)
         self.wrap_marker = ""
         # Override these to be no-ops.  Don't want to send self signals.
         self.commands["suspend"] = pyrepl.commands.Command
         self.commands["interrupt"] = pyrepl.commands.Command
+        self.commands["complete"] = complete
 
     def get_prompt(self, lineno, cursor_on_line):
         return self._get_prompt()
@@ -50,7 +124,168 @@ class Reader(pyrepl.historical_reader.HistoricalReader,
             return buffer[index+1:self.pos]
 
     def get_completions(self, stem):
-        return list(self._completer(self._completion_context, stem))
+        key = (self._completion_context, stem)
+        request = self._completion_request
+        if request is not None and request.key == key:
+            if request.ranked:
+                return list(request.matches)
+            return sorted(request.matches)
+        # Our complete command and pyrepl's both ask for the
+        # completions, so remember them for the current key press.
+        if self._completions_memo is None or self._completions_memo[0] != key:
+            self._completions_memo = (
+                key, list(self._completer(self._completion_context, stem)))
+        return list(self._completions_memo[1])
+
+    # Completion runs in a worker thread so that a slow filesystem
+    # does not block the main loop, which in the terminal is shared by
+    # all tabs.  We wait briefly so that fast completions behave just
+    # as if they were synchronous.  A repeated Tab press uses whatever
+    # matches have been found so far.
+    def completions_ready(self, repeated):
+        if self._stream_completer is None:
+            return True
+        key = (self._completion_context, self.get_stem())
+        request = self._completion_request
+        if request is None or request.key != key:
+            self._cancel_completion()
+            request = self._start_completion(key)
+        request.finished.wait(COMPLETION_WAIT)
+        if request.finished.isSet() or (repeated and len(request.matches) > 0):
+            request.waiting = False
+            return True
+        if not request.waiting:
+            request.waiting = True
+            gobject.timeout_add(COMPLETION_PROGRESS_INTERVAL,
+                                lambda: self._show_completion_progress(request))
+        self._show_completion_progress(request)
+        return False
+
+    def _start_completion(self, key):
+        request = CompletionRequest(key)
+        context, stem = key
+
+        def in_background():
+            try:
+                request.ranked = self._stream_completer(context, stem,
+                                                        request.add_match)
+            except CompletionCancelled:
+                pass
+            finally:
+                request.finished.set()
+
+        self._completion_request = request
+        shell_worker.get_default_pool().call(
+            in_background, lambda result: self._on_completion_done(request))
+        return request
+
+    def next_fuzzy_match(self):
+        completions, index = self.fuzzy_cycle
+        stem = self.get_stem()
+        del self.buffer[self.pos - len(stem):self.pos]
+        self.pos -= len(stem)
+        index = (index + 1) % len(completions)
+        self.insert(completions[index])
+        self.fuzzy_cycle = (completions, index)
+        self.msg = "[ fuzzy match %i of %i ]" % (index + 1, len(completions))
+        self.dirty = True
+
+    def _cancel_completion(self):
+        if self._completion_request is not None:
+            self._completion_request.cancelled = True
+            self._completion_request = None
+
+    def _on_completion_done(self, request):
+        if request is self._completion_request and request.waiting:
+            request.waiting = False
+            self.msg = ""
+            # Behave as for a first Tab press.
+            self.last_command = None
+            self.do_cmd(("complete", []))
+
+    def _show_completion_progress(self, request):
+        if request is not self._completion_request or not request.waiting:
+            return False
+        if time.time() > request.start_time + COMPLETION_TIMEOUT:
+            self._cancel_completion()
+            self.msg = "[ completion timed out ]"
+            self.dirty = True
+            self.refresh()
+            return False
+        self.msg = "[ completing: %i matches so far ]" % len(request.matches)
+        self.dirty = True
+        self.refresh()
+        return True
+
+    def prepare(self):
+        # Reload the history list for each prompt, because it depends
+        # on the current directory.  Don't do this when
+        # "operate-and-get-next" has selected an index into the list.
+        if self._get_history is not None and self.next_history is None:
+            history = self._get_history()
+            if history is not None:
+                self.history = history
+        self._suggestion = ("", "")
+        self._cancel_completion()
+        self.fuzzy_cycle = None
+        super(Reader, self).prepare()
+        self._active = True
+
+    def restore(self):
+        self._active = False
+        super(Reader, self).restore()
+
+    # Called when part of the prompt has been computed in the
+    # background.
+    def redraw_prompt(self):
+        if self._active:
+            self.dirty = True
+            self.refresh()
+
+    def _get_suggestion_suffix(self):
+        if (self._get_suggestion is None or
+            self.pos != len(self.buffer) or self.msg or
+            self.cmpltn_menu_vis):
+            return ""
+        line = self.get_unicode()
+        if "\n" in line:
+            return ""
+        if self._suggestion[0] != line:
+            suggestion = self._get_suggestion(line)
+            if suggestion is not None and suggestion.startswith(line):
+                suffix = suggestion[len(line):]
+            else:
+                suffix = ""
+            self._suggestion = (line, suffix)
+        return self._suggestion[1]
+
+    # Show the suggestion in grey after the cursor.  UnixConsole counts
+    # the escape sequences as printing characters when redrawing part
+    # of a line, so the suggestion only ever goes at the end of the
+    # line, where it does not affect the cursor position.
+    def calc_screen(self):
+        screen = super(Reader, self).calc_screen()
+        suffix = self._get_suggestion_suffix()
+        if suffix != "" and len(screen) > 0:
+            space = self.console.width - len(screen[-1]) - 1
+            if space > 0:
+                screen[-1] += "\x1b[90m%s\x1b[0m" % suffix[:space]
+        return screen
+
+    def do_cmd(self, cmd):
+        self._completions_memo = None
+        # Any other key press abandons a pending completion.
+        if cmd[0] != "complete":
+            self._cancel_completion()
+            self.fuzzy_cycle = None
+        # Moving right at the end of the line accepts the suggestion.
+        if (cmd[0] in ("right", "end-of-line") and
+            self.pos == len(self.buffer)):
+            suffix = self._get_suggestion_suffix()
+            if suffix != "":
+                self.insert(suffix)
+                return
+        super(Reader, self).do_cmd(cmd)
 
     def clear_error(self):
         self.msg = ""
@@ -75,5 +310,7 @@ class Reader(pyrepl.historical_reader.HistoricalReader,
         self.refresh()
 
 
-def make_reader(get_prompt, completer):
-    return Reader(get_prompt, completer, pyrepl.unix_console.UnixConsole())
+def make_reader(get_prompt, completer, get_history=None, get_suggestion=None,
+                stream_completer=None):
+    return Reader(get_prompt, completer, pyrepl.unix_console.UnixConsole(),
+                  get_history, get_suggestion, stream_completer)
@@ -0,0 +1,299 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Recording the output of each command, linked to its history row.
+#
+# Each recording is a gzipped file in the asciicast v2 format: a JSON
+# header line followed by one [time, "o", text] line per read from the
+# command's pty.  The main loop only queues the data that was read;
+# encoding, compressing and writing are done by a writer thread.  When
+# the recordings take up more than max_storage bytes, the oldest ones
+# are deleted.
+
+import codecs
+import collections
+import gzip
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+
+MAX_STORAGE = 200 << 20
+
+# Output from a command beyond this many bytes is not recorded.
+MAX_RECORDING_INPUT = 64 << 20
+
+# "history show-output" prints only the end of longer recordings.
+SHOW_OUTPUT_LIMIT = 1 << 20
+
+# This module is run as a separate process to print a recording, so
+# that the shell does not do a large write to the terminal it is
+# reading from.  The path is found now in case the cwd changes later.
+SCRIPT_PATH = os.path.abspath(__file__)
+
+
+class Recording(object):
+
+    def __init__(self, writer, header, get_time):
+        self._writer = writer
+        self._header = header
+        self._get_time = get_time
+        self._start_time = get_time()
+        self._size = 0
+        self._history_id = None
+        # Output read before we know the history ID.
+        self._buffered = []
+        self._closed = False
+
+    # Links the recording to its history row.  Recordings with no
+    # history row (e.g. because the command failed to parse) are
+    # discarded.
+    def set_history_id(self, history_id):
+        if history_id is None:
+            self._closed = True
+        if self._closed:
+            self._buffered = []
+            return
+        self._history_id = history_id
+        self._writer.send(("open", history_id, self._header))
+        for event in self._buffered:
+            self._writer.send(("data", history_id, event))
+        self._buffered = []
+
+    def write(self, data):
+        if self._closed or self._size >= MAX_RECORDING_INPUT:
+            return
+        self._size += len(data)
+        event = (self._get_time() - self._start_time, data)
+        if self._history_id is None:
+            self._buffered.append(event)
+        else:
+            self._writer.send(("data", self._history_id, event))
+
+    def close(self):
+        if self._history_id is not None and not self._closed:
+            self._writer.send(("close", self._history_id))
+        self._closed = True
+
+
+def list_recordings(directory):
+    recordings = []
+    for leafname in os.listdir(directory):
+        path = os.path.join(directory, leafname)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        recordings.append((st.st_mtime, st.st_size, path))
+    return recordings
+
+
+class RecordingWriter(object):
+
+    def __init__(self, directory, get_path, max_storage):
+        self._directory = directory
+        self._get_path = get_path
+        self._max_storage = max_storage
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def send(self, message):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+        self._queue.put(message)
+
+    # Waits until everything sent so far has been written.
+    def sync(self):
+        self._queue.join()
+
+    def _run(self):
+        # Maps history ID to (gzip file, UTF-8 decoder).
+        files = {}
+        total_size = None
+        while True:
+            message = self._queue.get()
+            try:
+                if total_size is None:
+                    if not os.path.exists(self._directory):
+                        os.mkdir(self._directory)
+                    total_size = sum(size for mtime, size, path
+                                     in list_recordings(self._directory))
+                total_size += self._handle(files, message)
+                if (message[0] == "close" and
+                    total_size > self._max_storage):
+                    total_size = self._evict(files)
+                # Flush when idle so that output from running commands
+                # can be read back.
+                if self._queue.empty():
+                    for fh, decoder in files.itervalues():
+                        fh.flush()
+            except Exception:
+                traceback.print_exc()
+                # Give up on the recording rather than writing a
+                # corrupt one.
+                if message[1] in files:
+                    files.pop(message[1])[0].close()
+            self._queue.task_done()
+
+    # Returns the number of bytes added to the directory.
+    def _handle(self, files, message):
+        kind, history_id = message[:2]
+        if kind == "open":
+            fh = gzip.open(self._get_path(history_id), "wb")
+            fh.write(json.dumps(message[2]) + "\n")
+            files[history_id] = (
+                fh, codecs.getincrementaldecoder("utf-8")("replace"))
+        elif history_id not in files:
+            pass
+        elif kind == "data":
+            fh, decoder = files[history_id]
+            time_offset, data = message[2]
+            text = decoder.decode(data)
+            if len(text) > 0:
+                fh.write(json.dumps([round(time_offset, 6), "o", text])
+                         + "\n")
+        elif kind == "close":
+            fh, decoder = files.pop(history_id)
+            fh.close()
+            return os.path.getsize(self._get_path(history_id))
+        return 0
+
+    # Deletes the oldest recordings until we are within the limit.
+    # Returns the new total size.
+    def _evict(self, files):
+        open_paths = set(self._get_path(history_id) for history_id in files)
+        recordings = sorted(list_recordings(self._directory))
+        total_size = sum(size for mtime, size, path in recordings)
+        for mtime, size, path in recordings:
+            if total_size <= self._max_storage:
+                break
+            if path in open_paths:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total_size -= size
+        return total_size
+
+
+class OutputStore(object):
+
+    def __init__(self, directory, max_storage=MAX_STORAGE,
+                 get_time=time.time):
+        self._directory = directory
+        self._get_time = get_time
+        self._writer = RecordingWriter(directory, self._get_path, max_storage)
+
+    def sync(self):
+        self._writer.sync()
+
+    def _get_path(self, history_id):
+        return os.path.join(self._directory, "%i.cast.gz" % history_id)
+
+    def start_recording(self, command, width, height):
+        header = {"version": 2,
+                  "width": width,
+                  "height": height,
+                  "timestamp": int(self._get_time()),
+                  "command": command}
+        return Recording(self._writer, header, self._get_time)
+
+    # Returns the path of the recording, or None if there is none.
+    def get_recording_path(self, history_id):
+        path = self._get_path(history_id)
+        if os.path.exists(path):
+            return path
+        return None
+
+    # Returns the recorded output as a string, or None if there is no
+    # recording.  The recording may still be being written, in which
+    # case we return what has been flushed so far.
+    def read_output(self, history_id):
+        try:
+            fh = gzip.open(self._get_path(history_id), "rb")
+        except IOError:
+            return None
+        try:
+            return "".join(iter_output(fh))
+        finally:
+            fh.close()
+
+
+# Yields the recorded output, UTF-8 encoded, in the pieces that were
+# read from the pty.
+def iter_output(fh):
+    try:
+        fh.readline()
+        for line in fh:
+            yield json.loads(line)[2].encode("utf-8")
+    except (IOError, EOFError, ValueError, IndexError):
+        # Truncated at the end.
+        pass
+
+
+# Writes the end of the recording in fh to out, decoding it as it is
+# read so that only about "limit" bytes are kept in memory.
+def write_output_tail(fh, out, limit=SHOW_OUTPUT_LIMIT):
+    chunks = collections.deque()
+    size = 0
+    dropped = 0
+    for data in iter_output(fh):
+        chunks.append(data)
+        size += len(data)
+        while size - len(chunks[0]) >= limit:
+            data = chunks.popleft()
+            size -= len(data)
+            dropped += len(data)
+    data = "".join(chunks)
+    if len(data) > limit:
+        # Drop up to a line boundary.
+        start = len(data) - limit
+        end = data.find("\n", start) + 1
+        if end == 0:
+            end = start
+        dropped += end
+        data = data[end:]
+    if dropped > 0:
+        out.write("[%i earlier bytes not shown]\n" % dropped)
+    out.write(data)
+
+
+def main(args):
+    if len(args) != 2 or args[0] != "show-output":
+        sys.stderr.write("Usage: %s show-output FILE\n" % sys.argv[0])
+        sys.exit(1)
+    try:
+        fh = gzip.open(args[1], "rb")
+    except IOError, exn:
+        sys.stderr.write("history: %s\n" % exn)
+        sys.exit(1)
+    try:
+        write_output_tail(fh, sys.stdout)
+    finally:
+        fh.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
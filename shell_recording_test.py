@@ -0,0 +1,119 @@
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+import gzip
+import json
+import os
+import StringIO
+import subprocess
+import sys
+import unittest
+
+import shell_recording
+import tempdir_test
+
+
+class OutputStoreTest(tempdir_test.TempDirTestCase):
+
+    def make_store(self, **kwargs):
+        return shell_recording.OutputStore(
+            os.path.join(self.make_temp_dir(), "output"), **kwargs)
+
+    def record(self, store, history_id, chunks):
+        recording = store.start_recording("cmd %i" % history_id, 80, 24)
+        for chunk in chunks:
+            recording.write(chunk)
+        recording.set_history_id(history_id)
+        recording.close()
+        store.sync()
+
+    def test_recording(self):
+        store = self.make_store()
+        # The UTF-8 character is split across reads.
+        self.record(store, 1, ["foo\r\n", "\xc3", "\xa9\r\n"])
+        self.assertEquals(store.read_output(1), "foo\r\n\xc3\xa9\r\n")
+        self.assertEquals(store.read_output(2), None)
+        fh = gzip.open(store._get_path(1))
+        header = json.loads(fh.readline())
+        self.assertEquals(header["command"], "cmd 1")
+        self.assertEquals((header["width"], header["height"]), (80, 24))
+        event = json.loads(fh.readline())
+        self.assertEquals(event[1:], ["o", "foo\r\n"])
+
+    def test_output_after_linking(self):
+        store = self.make_store()
+        recording = store.start_recording("cmd", 80, 24)
+        recording.write("before\n")
+        recording.set_history_id(1)
+        recording.write("after\n")
+        store.sync()
+        # Output can be read before the recording is finished.
+        self.assertEquals(store.read_output(1), "before\nafter\n")
+        recording.close()
+        store.sync()
+        self.assertEquals(store.read_output(1), "before\nafter\n")
+
+    def test_unlinked_recording_discarded(self):
+        temp_dir = self.make_temp_dir()
+        store = shell_recording.OutputStore(temp_dir)
+        recording = store.start_recording("cmd", 80, 24)
+        recording.write("data\n")
+        recording.set_history_id(None)
+        recording.close()
+        store.sync()
+        self.assertEquals(os.listdir(temp_dir), [])
+
+    def test_eviction(self):
+        store = self.make_store(max_storage=3000)
+        for history_id in range(10):
+            # Incompressible output.
+            self.record(store, history_id, [os.urandom(1000)])
+            os.utime(store._get_path(history_id),
+                     (history_id, history_id))
+        self.assertEquals(store.read_output(0), None)
+        self.assertNotEquals(store.read_output(9), None)
+        size = sum(os.path.getsize(store._get_path(history_id))
+                   for history_id in range(10)
+                   if os.path.exists(store._get_path(history_id)))
+        self.assertTrue(size <= 3000, size)
+
+    def test_output_tail(self):
+        store = self.make_store()
+        self.record(store, 1, ["line %i\n" % index for index in range(10)])
+        path = store.get_recording_path(1)
+        self.assertEquals(store.get_recording_path(2), None)
+        out = StringIO.StringIO()
+        shell_recording.write_output_tail(gzip.open(path), out)
+        self.assertEquals(out.getvalue(), store.read_output(1))
+        out = StringIO.StringIO()
+        shell_recording.write_output_tail(gzip.open(path), out, limit=15)
+        # Output is dropped up to a line boundary.
+        self.assertEquals(out.getvalue(),
+                          "[56 earlier bytes not shown]\nline 8\nline 9\n")
+
+    def test_show_output_script(self):
+        store = self.make_store()
+        self.record(store, 1, ["foo\n"])
+        proc = subprocess.Popen(
+            [sys.executable, shell_recording.SCRIPT_PATH, "show-output",
+             store.get_recording_path(1)], stdout=subprocess.PIPE)
+        self.assertEquals(proc.communicate()[0], "foo\n")
+        self.assertEquals(proc.wait(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
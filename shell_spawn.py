@@ -109,7 +109,7 @@ class NullProcessGroup(object):
 
 
 subprocess_keys = set(["args", "fds", "environ", "cwd_fd", "pgroup",
-                       "uid", "gid", "groups"])
+                       "uid", "gid", "groups", "command_suggestions"])
 
 def spawn_subprocess(spec):
     args = spec["args"]
@@ -134,6 +134,9 @@ def spawn_subprocess(spec):
                 os.execvpe(args[0], args, spec.get("environ", os.environ))
             except OSError:
                 sys.stderr.write("%s: command not found\n" % args[0])
+                if len(spec.get("command_suggestions", [])) > 0:
+                    sys.stderr.write("Did you mean: %s\n"
+                                     % ", ".join(spec["command_suggestions"]))
         except:
             traceback.print_exc()
     pid = in_forked(in_subprocess)
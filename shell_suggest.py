@@ -0,0 +1,259 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Fish-style suggestions of whole command lines from history.
+
+import heapq
+import math
+import os
+
+
+# Scores are kept as log2 of a sum of 2**(time / HALF_LIFE) over each
+# use of a command.  This combines frequency and recency, and because
+# all scores decay at the same rate, comparisons between scores never
+# need to be recomputed as time passes.
+HALF_LIFE = 7 * 24 * 60 * 60 # seconds
+
+# Bonus, in the same units as scores, given to commands that have
+# been used in the current directory.
+DIR_BONUS = 2.0
+
+# Number of candidates kept at each trie node.
+NODE_CANDIDATES = 8
+
+# Trie nodes are only created for this many characters of each
+# command.  Longer prefixes are matched by scanning the commands
+# stored at the deepest node, which share a long prefix and so are
+# few in number.
+MAX_DEPTH = 8
+
+# Number of directories remembered for each command.
+MAX_DIRS = 8
+
+MAX_ENTRIES = 20000
+
+
+def log_add(a, b):
+    if a is None:
+        return b
+    high = max(a, b)
+    return high + math.log(1 + 2 ** (min(a, b) - high), 2)
+
+
+def get_use_score(when):
+    return float(when) / HALF_LIFE
+
+
+# Scores can be summed by the database as weights relative to a
+# reference time, which avoids overflowing floats.  The exponent is
+# bounded so that very old uses don't have a weight of zero.
+def get_use_weight(now, when):
+    return 2 ** max(float(when - now) / HALF_LIFE, -1000)
+
+
+def weight_to_score(now, weight):
+    return get_use_score(now) + math.log(weight, 2)
+
+
+class Entry(object):
+
+    __slots__ = ["command", "score", "dirs"]
+
+    def __init__(self, command):
+        self.command = command
+        self.score = None
+        self.dirs = {}
+
+    # Adds count uses with a combined score of score.
+    def add_uses(self, dir_key, count, score):
+        self.score = log_add(self.score, score)
+        if dir_key is not None:
+            self.dirs[dir_key] = self.dirs.get(dir_key, 0) + count
+            if len(self.dirs) > MAX_DIRS:
+                least = min(self.dirs, key=self.dirs.get)
+                del self.dirs[least]
+
+    def get_score(self, dir_key):
+        count = self.dirs.get(dir_key, 0)
+        if count > 0:
+            return self.score + DIR_BONUS + math.log(count, 2)
+        return self.score
+
+
+class Node(object):
+
+    __slots__ = ["children", "best", "members"]
+
+    def __init__(self):
+        self.children = {}
+        # Best entries for this prefix, highest score first.
+        self.best = []
+        # Only used at MAX_DEPTH: all entries with this prefix.
+        self.members = None
+
+    def update_best(self, entry):
+        best = self.best
+        if entry in best:
+            best.remove(entry)
+        elif (len(best) >= NODE_CANDIDATES and
+              entry.score <= best[-1].score):
+            return
+        index = 0
+        while index < len(best) and best[index].score >= entry.score:
+            index += 1
+        best.insert(index, entry)
+        del best[NODE_CANDIDATES:]
+
+
+class SuggestionTrie(object):
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self._max_entries = max_entries
+        self._entries = {}
+        self._root = Node()
+        # Heap of (score, command) for finding the lowest-scoring
+        # entry.  Scores only grow, so items whose score is out of date
+        # are left in place and skipped.
+        self._heap = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, command, dir_key, when):
+        self.add_uses(command, dir_key, 1, get_use_score(when))
+
+    # Adds count uses of command in dir_key with a combined score of
+    # score.  This is used for loading uses that have been summarised
+    # by the database.
+    def add_uses(self, command, dir_key, count, score):
+        command = command.strip()
+        if command == "":
+            return
+        entry = self._entries.get(command)
+        if entry is None:
+            entry = Entry(command)
+            self._entries[command] = entry
+        entry.add_uses(dir_key, count, score)
+        self._insert(entry)
+        heapq.heappush(self._heap, (entry.score, command))
+        if len(self._heap) > 2 * len(self._entries):
+            # Drop the out of date items.
+            self._heap = [(other.score, other.command)
+                          for other in self._entries.itervalues()]
+            heapq.heapify(self._heap)
+        if len(self._entries) > self._max_entries:
+            self._remove_lowest()
+
+    def _insert(self, entry):
+        node = self._root
+        node.update_best(entry)
+        for char in entry.command[:MAX_DEPTH]:
+            child = node.children.get(char)
+            if child is None:
+                child = Node()
+                node.children[char] = child
+            node = child
+            node.update_best(entry)
+        if len(entry.command) >= MAX_DEPTH:
+            if node.members is None:
+                node.members = set()
+            node.members.add(entry)
+
+    def _remove_lowest(self):
+        while True:
+            score, command = heapq.heappop(self._heap)
+            entry = self._entries.get(command)
+            if entry is not None and entry.score == score:
+                self._remove(entry)
+                return
+
+    def _remove(self, entry):
+        del self._entries[entry.command]
+        command = entry.command
+        path = [self._root]
+        for char in command[:MAX_DEPTH]:
+            path.append(path[-1].children[char])
+        if path[-1].members is not None:
+            path[-1].members.discard(entry)
+        # Work upwards, so that each node's candidates can be refilled
+        # from its children's.  Low-scoring entries are rarely
+        # candidates, so usually there is nothing to do.
+        for depth in xrange(len(path) - 1, -1, -1):
+            node = path[depth]
+            if entry in node.best:
+                self._refill(node, command[:depth])
+            if depth > 0 and len(node.best) == 0 and len(node.children) == 0:
+                del path[depth - 1].children[command[depth - 1]]
+
+    # Recomputes a node's candidates after one has been removed.
+    def _refill(self, node, prefix):
+        if node.members is not None:
+            candidates = set(node.members)
+        else:
+            candidates = set()
+            for child in node.children.itervalues():
+                candidates.update(child.best)
+            entry = self._entries.get(prefix)
+            if entry is not None:
+                candidates.add(entry)
+        node.best = heapq.nlargest(NODE_CANDIDATES, candidates,
+                                   key=lambda entry: entry.score)
+
+    def _candidates(self, prefix):
+        node = self._root
+        for char in prefix[:MAX_DEPTH]:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        if len(prefix) < MAX_DEPTH:
+            return node.best
+        return [entry for entry in node.members or ()
+                if entry.command.startswith(prefix)]
+
+    # Returns the best history entry that extends prefix, or None.
+    def suggest(self, prefix, dir_key):
+        if prefix.strip() == "":
+            return None
+        best = None
+        best_score = None
+        for entry in self._candidates(prefix):
+            if len(entry.command) <= len(prefix):
+                continue
+            score = entry.get_score(dir_key)
+            if best is None or score > best_score:
+                best = entry
+                best_score = score
+        if best is None:
+            return None
+        return best.command
+
+
+# Counts how often each word, or the last component of each pathname,
+# appears in commands.  Used for ranking fuzzy completions.
+class UsageCounts(object):
+
+    def __init__(self):
+        self._counts = {}
+
+    def add(self, command, count=1):
+        for word in command.split():
+            leaf = os.path.basename(word.rstrip("/"))
+            self._counts[leaf] = self._counts.get(leaf, 0) + count
+
+    def get(self, name):
+        return self._counts.get(name, 0)
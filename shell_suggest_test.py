@@ -0,0 +1,114 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+import unittest
+
+import shell_suggest
+
+
+DAY = 24 * 60 * 60
+
+
+class SuggestionTrieTest(unittest.TestCase):
+
+    def test_frequency(self):
+        trie = shell_suggest.SuggestionTrie()
+        trie.add("make clean", None, 1000)
+        trie.add("make all", None, 1000)
+        trie.add("make all", None, 1000)
+        self.assertEquals(trie.suggest("ma", None), "make all")
+        self.assertEquals(trie.suggest("make c", None), "make clean")
+        self.assertEquals(trie.suggest("make all", None), None)
+        self.assertEquals(trie.suggest("", None), None)
+        self.assertEquals(trie.suggest("x", None), None)
+
+    def test_recency(self):
+        trie = shell_suggest.SuggestionTrie()
+        trie.add("make all", None, 0)
+        trie.add("make all", None, 0)
+        trie.add("make clean", None, 30 * DAY)
+        self.assertEquals(trie.suggest("make", None), "make clean")
+
+    def test_directory_affinity(self):
+        trie = shell_suggest.SuggestionTrie()
+        trie.add("make all", "dir1", 1000)
+        trie.add("make all", "dir1", 1000)
+        trie.add("make clean", "dir2", 1000)
+        self.assertEquals(trie.suggest("make", "dir1"), "make all")
+        self.assertEquals(trie.suggest("make", "dir2"), "make clean")
+
+    def test_long_prefixes(self):
+        trie = shell_suggest.SuggestionTrie()
+        trie.add("git commit -a", None, 1000)
+        trie.add("git commit -a", None, 1000)
+        trie.add("git commit --amend", None, 1000)
+        self.assertEquals(trie.suggest("git commit -", None), "git commit -a")
+        self.assertEquals(trie.suggest("git commit --", None),
+                          "git commit --amend")
+
+    def test_pruning(self):
+        trie = shell_suggest.SuggestionTrie(max_entries=50)
+        trie.add("frequent", None, 1000)
+        trie.add("frequent", None, 1000)
+        for index in range(100):
+            trie.add("rare %i" % index, None, 1000)
+        assert len(trie) <= 50
+        self.assertEquals(trie.suggest("fr", None), "frequent")
+
+    def test_pruning_refills_candidate_lists(self):
+        trie = shell_suggest.SuggestionTrie(max_entries=9)
+        # "c8" is not one of the candidates for "c" at first, because
+        # there are already enough candidates with the same score.
+        for index in range(9):
+            trie.add("c%i" % index, None, 0)
+        # These push out all the others.
+        for index in range(8):
+            trie.add("d%i" % index, None, DAY)
+        self.assertEquals(len(trie), 9)
+        self.assertEquals(trie.suggest("c", None), "c8")
+        self.assertEquals(trie.suggest("d", "dir"), "d0")
+
+    def test_summarised_uses(self):
+        now = 100 * DAY
+        weight = sum(shell_suggest.get_use_weight(now, when)
+                     for when in (10 * DAY, 20 * DAY))
+        trie1 = shell_suggest.SuggestionTrie()
+        trie1.add_uses("make", "dir", 2,
+                       shell_suggest.weight_to_score(now, weight))
+        trie2 = shell_suggest.SuggestionTrie()
+        trie2.add("make", "dir", 10 * DAY)
+        trie2.add("make", "dir", 20 * DAY)
+        entry1 = trie1._entries["make"]
+        entry2 = trie2._entries["make"]
+        self.assertAlmostEquals(entry1.score, entry2.score)
+        self.assertEquals(entry1.dirs, entry2.dirs)
+
+
+class UsageCountsTest(unittest.TestCase):
+
+    def test_counts(self):
+        counts = shell_suggest.UsageCounts()
+        counts.add("ls /usr/bin/")
+        counts.add("ls foo", 3)
+        self.assertEquals(counts.get("ls"), 4)
+        self.assertEquals(counts.get("bin"), 1)
+        self.assertEquals(counts.get("foo"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
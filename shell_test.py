@@ -28,6 +28,8 @@ import pyparsing as parse
 
 import jobcontrol
 import shell
+import shell_recording
+import shell_suggest
 import tempdir_test
 
 
@@ -149,6 +151,19 @@ class ShellTests(TestCase):
         self.assertEquals(read_stderr.read(),
                           "made-up-command-123: command not found\n")
 
+    def test_command_not_found_suggestions(self):
+        bin_dir = self.make_temp_dir()
+        write_file(os.path.join(bin_dir, "frobnicate"), "")
+        os.chmod(os.path.join(bin_dir, "frobnicate"), 0755)
+        self.patch_env_var("PATH", bin_dir)
+        write_stderr, read_stderr = make_fh_pair()
+        run_command("frobnciate",
+                    std_fds(stdin=open(os.devnull, "r"),
+                            stdout=open(os.devnull, "w"), stderr=write_stderr))
+        self.assertEquals(read_stderr.read(),
+                          "frobnciate: command not found\n"
+                          "Did you mean: frobnicate\n")
+
     def test_globbing(self):
         temp_dir = self.make_temp_dir()
         write_file(os.path.join(temp_dir, "aaa"), "")
@@ -225,6 +240,22 @@ class ShellTests(TestCase):
         os.environ["PWD"] = "/does/not/exist"
         self.assertEquals(cwd_tracker.get_cwd(), physical_path)
 
+    def test_logical_cwd_caching(self):
+        now = [0]
+        cwd = shell.LogicalCwd(shell.LocalCwdTracker(), {}, cache_interval=10,
+                               get_time=lambda: now[0])
+        temp_dir = self.make_temp_dir()
+        os.mkdir(os.path.join(temp_dir, "dir1"))
+        cwd.chdir(os.path.join(temp_dir, "dir1"))
+        self.assertEquals(cwd.get_cwd(), os.path.join(temp_dir, "dir1"))
+        os.rename(os.path.join(temp_dir, "dir1"), os.path.join(temp_dir, "dir2"))
+        self.assertEquals(cwd.get_cwd(), os.path.join(temp_dir, "dir1"))
+        now[0] = 10
+        self.assertEquals(cwd.get_cwd(), os.path.join(temp_dir, "dir2"))
+        os.rename(os.path.join(temp_dir, "dir2"), os.path.join(temp_dir, "dir3"))
+        cwd.invalidate()
+        self.assertEquals(cwd.get_cwd(), os.path.join(temp_dir, "dir3"))
+
     def test_logical_chdir(self):
         cwd_tracker = make_shell().cwd
         temp_dir = self.make_temp_dir()
@@ -263,6 +294,15 @@ class ShellTests(TestCase):
         self.assertEquals(sorted(shell.complete_filename("a-")),
                           ["a-dir/", "a-file"])
 
+    def test_fuzzy_completion(self):
+        temp_dir = self.make_temp_dir()
+        os.mkdir(os.path.join(temp_dir, "alpha-dir"))
+        write_file(os.path.join(temp_dir, "beta-file"), "")
+        os.chdir(temp_dir)
+        self.assertEquals(list(shell.complete_filename("pd", fuzzy=True)),
+                          ["alpha-dir/"])
+        self.assertEquals(list(shell.complete_filename("pd")), [])
+
     def test_completion_with_tilde_expansion(self):
         home_dir = self.make_temp_dir()
         self.patch_env_var("HOME", home_dir)
@@ -373,6 +413,29 @@ class ShellTests(TestCase):
         self.assertEquals(read_stdout.read(), "bar1234\n")
 
 
+class CompletionCacheTest(unittest.TestCase):
+
+    def test_matches_computed_once(self):
+        calls = []
+        def completer(context, string):
+            calls.append((context, string))
+            for match in ["foo1", "foo2"]:
+                yield match
+        now = [0]
+        cache = shell.CompletionCache(completer, get_time=lambda: now[0])
+        for attempt in range(2):
+            self.assertEquals([cache.get_match("ls fo", 3, "fo", index)
+                               for index in range(3)],
+                              ["foo1", "foo2", None])
+        self.assertEquals(calls, [("ls ", "fo")])
+        self.assertEquals(cache.get_match("ls foo", 3, "foo", 0), "foo1")
+        self.assertEquals(len(calls), 2)
+        # A later session with the same line recomputes the matches.
+        now[0] += 100
+        self.assertEquals(cache.get_match("ls foo", 3, "foo", 0), "foo1")
+        self.assertEquals(len(calls), 3)
+
+
 class FDRedirectionTests(tempdir_test.TempDirTestCase):
 
     def fds_for_command(self, command, fds):
@@ -657,6 +720,37 @@ class JobControlTests(unittest.TestCase):
             std_fds(stdin=sys.stdin, stdout=write_fh, stderr=sys.stderr))
         self.assertEquals(read_fh.read(), "[1] Done  true &\n")
 
+    def test_showing_job_output(self):
+        self.job_controller.shell_to_foreground()
+        self.run_job_command(
+            "true &",
+            std_fds(stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr))
+        output = jobcontrol.OutputRing(10)
+        output.write("dropped\nkept\n")
+        self.job_controller.jobs[1].output = output
+        self.dispatcher.once(may_block=True)
+        self.assert_messages(["[1] %i\n" % self.job_controller.jobs[1].pgid,
+                              "[1]+ Done  true &\n"])
+        # The output is kept after the job has finished.
+        self.assertEquals(self.job_controller.jobs.keys(), [])
+        write_fh, read_fh = make_fh_pair()
+        # The output is written by a child process, not by the shell.
+        self.run_job_command(
+            "jobs -o 1",
+            std_fds(stdin=sys.stdin, stdout=write_fh, stderr=sys.stderr))
+        self.dispatcher.once(may_block=True)
+        self.job_controller.shell_to_foreground()
+        self.assertEquals(read_fh.read(),
+                          "[3 earlier bytes not kept]\nkept\n")
+
+    def test_showing_output_of_unknown_job(self):
+        for args in ("5", "x", "1 2"):
+            write_fh, read_fh = make_fh_pair()
+            self.run_job_command(
+                "jobs -o %s" % args,
+                std_fds(stdin=sys.stdin, stdout=sys.stdout, stderr=write_fh))
+            self.assertEquals(read_fh.read(), "jobs: no such job %s\n" % args)
+
     def test_bg(self):
         self.job_controller.shell_to_foreground()
         write_fd, read_fd = make_fh_pair()
@@ -698,6 +792,29 @@ class JobControlTests(unittest.TestCase):
         self.assert_messages([])
 
 
+class OutputRingTest(unittest.TestCase):
+
+    def test_keeps_tail(self):
+        ring = jobcontrol.OutputRing(10)
+        ring.write("abc\n")
+        self.assertEquals(ring.get_tail(), "abc\n")
+        ring.write("defgh\nij")
+        # Output is dropped up to a line boundary.
+        self.assertEquals(ring.get_tail(), "defgh\nij")
+        self.assertEquals(ring.get_dropped_size(), 2)
+        ring.write("x" * 25 + "\nyz")
+        self.assertEquals(ring.get_tail(), "yz")
+        self.assertEquals(ring.get_dropped_size(), 30)
+
+    def test_file_backed(self):
+        ring = jobcontrol.OutputRing(jobcontrol.MAX_MEMORY_OUTPUT_SIZE * 2)
+        lines = "".join("line %i\n" % i for i in range(300000))
+        ring.write(lines)
+        tail = ring.get_tail()
+        self.assertTrue(lines.endswith(tail))
+        self.assertTrue(tail.startswith("line "))
+
+
 class HistoryTest(TestCase):
 
     def test_creating_database(self):
@@ -709,6 +826,111 @@ class HistoryTest(TestCase):
         cursor = history.sqldb.execute("SELECT command FROM history")
         self.assertEquals(list(cursor), [("true",)])
 
+    def test_recall_list_prefers_current_directory(self):
+        self.patch_env_var("HOME", self.make_temp_dir())
+        sh = make_shell({"history": shell.History()})
+        dir1 = self.make_temp_dir()
+        dir2 = self.make_temp_dir()
+        sh.cwd.chdir(dir1)
+        sh.history.add_command("echo a", sh.cwd)
+        sh.cwd.chdir(dir2)
+        sh.history.add_command("echo b", sh.cwd)
+        sh.history.add_command("echo c", sh.cwd)
+        sh.history.add_command("echo b", sh.cwd)
+        sh.cwd.chdir(dir1)
+        self.assertEquals(sh.get_recall_list(), ["echo c", "echo b", "echo a"])
+        sh.cwd.chdir(dir2)
+        self.assertEquals(sh.get_recall_list(), ["echo a", "echo c", "echo b"])
+
+    def test_show_output(self):
+        self.patch_env_var("HOME", self.make_temp_dir())
+        output_store = shell_recording.OutputStore(self.make_temp_dir())
+        sh = make_shell({"history": shell.History(),
+                         "output_store": output_store})
+        history_id = sh.run_command("true", {})
+        recording = output_store.start_recording("true", 80, 24)
+        recording.write("recorded output\n")
+        recording.set_history_id(history_id)
+        recording.close()
+        output_store.sync()
+        write_fd, read_fd = make_fh_pair()
+        sh.run_command("history show-output %i" % history_id,
+                       std_fds(stdin=sys.stdin, stdout=write_fd,
+                               stderr=sys.stderr))
+        write_fd.close()
+        self.assertEquals(read_fd.read(), "recorded output\n")
+
+    def test_sharing_history_between_processes(self):
+        self.patch_env_var("HOME", self.make_temp_dir())
+        sh1 = make_shell({"history": shell.History()})
+        sh2 = make_shell({"history": shell.History()})
+        sh1.history.add_command("echo a", sh1.cwd)
+        sh2.history.poll()
+        self.assertEquals(sh2.get_recall_list(), ["echo a"])
+        sh1.history.add_command("echo b", sh1.cwd)
+        # The recall list is cached until poll() notices the change.
+        self.assertEquals(sh2.get_recall_list(), ["echo a"])
+        sh2.history.poll()
+        self.assertEquals(sh2.get_recall_list(), ["echo a", "echo b"])
+
+    def test_bulk_import_while_loading_suggestions(self):
+        self.patch_env_var("HOME", self.make_temp_dir())
+        history = shell.History()
+        # Pretend that a load has started.
+        history._pending_suggestions = []
+        generation = history._suggestion_generation
+        other = shell.History()
+        other.sqldb.executemany(
+            "INSERT INTO history (time, command) VALUES (datetime('now'), ?)",
+            (("echo %i" % i,)
+             for i in xrange(shell.SUGGESTION_LOAD_LIMIT + 1)))
+        other.sqldb.commit()
+        history.poll()
+        # The load that was running is discarded when it finishes.
+        history._finish_loading_suggestions(
+            generation, shell_suggest.SuggestionTrie(),
+            shell_suggest.UsageCounts())
+        self.assertEquals(history._suggestions, None)
+        self.assertEquals(history._pending_suggestions, None)
+
+    def test_suggest(self):
+        self.patch_env_var("HOME", self.make_temp_dir())
+        sh = make_shell({"history": shell.History()})
+        sh.cwd.chdir(self.make_temp_dir())
+        history = sh.history
+        history._pending_suggestions = []
+        history._finish_loading_suggestions(
+            history._suggestion_generation, shell_suggest.SuggestionTrie(),
+            shell_suggest.UsageCounts())
+        history.add_command("echo hello", sh.cwd)
+        history.poll()
+        # This uses the shell's GlobalCwdTracker, whose get_cwd_fd()
+        # returns a new FD each time.
+        self.assertEquals(history.suggest(sh.real_cwd, "ec"), "echo hello")
+
+    def test_jump_to_directory(self):
+        self.patch_env_var("HOME", self.make_temp_dir())
+        sh = make_shell({"history": shell.History()})
+        temp_dir = self.make_temp_dir()
+        dir1 = os.path.join(temp_dir, "project-foo")
+        dir2 = os.path.join(temp_dir, "project-bar")
+        os.mkdir(dir1)
+        os.mkdir(dir2)
+        sh.cwd.chdir(dir1)
+        sh.history.add_command("true", sh.cwd)
+        sh.history.add_command("true", sh.cwd)
+        sh.cwd.chdir(dir2)
+        sh.history.add_command("true", sh.cwd)
+        sh.cwd.chdir(temp_dir)
+        sh.run_command("j proj", {})
+        self.assertEquals(sh.cwd.get_cwd(), dir1)
+        sh.run_command("j bar", {})
+        self.assertEquals(sh.cwd.get_cwd(), dir2)
+        write_stderr, read_stderr = make_fh_pair()
+        sh.run_command("j no-such-dir", {2: write_stderr})
+        self.assertEquals(read_stderr.read(), "j: no matching directory\n")
+        self.assertEquals(sh.cwd.get_cwd(), dir2)
+
 
 if __name__ == "__main__":
     unittest.main()
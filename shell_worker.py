@@ -0,0 +1,89 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Running blocking operations (such as listing directories on slow
+# filesystems) outside of the glib main loop.
+
+import Queue
+import threading
+import traceback
+
+import gobject
+
+
+def call_once(func, *args):
+    func(*args)
+    # Remove the idle handler.
+    return False
+
+
+class WorkerPool(object):
+
+    # Workers can get stuck indefinitely, e.g. on a hung NFS mount, so
+    # rather than having a fixed number of threads we start a new one
+    # whenever none are idle, up to a limit.
+    def __init__(self, max_threads=16):
+        self._max_threads = max_threads
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+        # Need to initialise threads otherwise pygobject won't drop
+        # the Python GIL while doing an iteration of the glib loop.
+        gobject.threads_init()
+
+    def _set_idle(self, delta):
+        self._lock.acquire()
+        self._idle += delta
+        self._lock.release()
+
+    def _worker(self):
+        while True:
+            self._set_idle(1)
+            func, callback = self._queue.get()
+            self._set_idle(-1)
+            try:
+                result = func()
+            except:
+                traceback.print_exc()
+                result = None
+            if callback is not None:
+                gobject.idle_add(call_once, callback, result)
+
+    # Calls func() in a worker thread, then callback(result) from the
+    # main loop.  If func() raises an exception, result is None.
+    def call(self, func, callback=None):
+        self._lock.acquire()
+        try:
+            if (self._idle <= self._queue.qsize() and
+                self._threads < self._max_threads):
+                self._threads += 1
+                thread = threading.Thread(target=self._worker)
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self._lock.release()
+        self._queue.put((func, callback))
+
+
+_default_pool = []
+
+def get_default_pool():
+    if len(_default_pool) == 0:
+        _default_pool.append(WorkerPool())
+    return _default_pool[0]
@@ -20,9 +20,12 @@
 # Integrated terminal GUI and shell.
 
 import cgi
+import errno
 import os
+import re
 import fcntl
 import signal
+import socket
 import struct
 import termios
 import time
@@ -30,6 +33,7 @@ import traceback
 
 import gobject
 import gtk
+import pango
 import vte
 
 import pyrepl.unix_console
@@ -39,6 +43,10 @@ import jobcontrol
 import shell
 import shell_event
 import shell_pyrepl
+import shell_worker
+import terminal_client
+import terminal_output
+import terminal_scrollback
 
 
 def openpty():
@@ -46,6 +54,62 @@ def openpty():
     return os.fdopen(master_fd, "w"), os.fdopen(slave_fd, "w")
 
 
+def open_job_pty():
+    master_fd, slave_fd = openpty()
+    # Setting O_NONBLOCK shouldn't be necessary, but poll() will
+    # sometimes report the FD as ready to read when reading it
+    # will block.
+    fcntl.fcntl(master_fd, fcntl.F_SETFL,
+                fcntl.fcntl(master_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return master_fd, slave_fd
+
+
+# Number of ptys each tab opens in advance.
+PTY_POOL_SIZE = 2
+
+
+# Keeps some ptys open ready for the next commands, so that opening
+# them is not on the path between pressing Enter and the command
+# starting.  The pool is refilled when the main loop is idle.  ptys
+# are never reused, because a backgrounded job may still have the old
+# one open, so each command gets a fresh pty with default settings.
+class PtyPool(object):
+
+    def __init__(self, size=PTY_POOL_SIZE):
+        self._size = size
+        self._ptys = []
+        self._refilling = False
+        self._schedule_refill()
+
+    def get(self):
+        if len(self._ptys) > 0:
+            pty = self._ptys.pop(0)
+        else:
+            pty = open_job_pty()
+        self._schedule_refill()
+        return pty
+
+    def _schedule_refill(self):
+        if not self._refilling and len(self._ptys) < self._size:
+            self._refilling = True
+            gobject.idle_add(self._refill, priority=gobject.PRIORITY_LOW)
+
+    # Opens one pty per idle callback, so as not to delay input.
+    def _refill(self):
+        if len(self._ptys) < self._size:
+            self._ptys.append(open_job_pty())
+        self._refilling = len(self._ptys) < self._size
+        return self._refilling
+
+    def close(self):
+        for master_fd, slave_fd in self._ptys:
+            master_fd.close()
+            slave_fd.close()
+        self._ptys = []
+        # Stop refilling.
+        self._size = 0
+
+
 class VTEConsole(pyrepl.unix_console.UnixConsole):
 
     def __init__(self, terminal):
@@ -54,8 +118,9 @@ class VTEConsole(pyrepl.unix_console.UnixConsole):
 
     # TODO: Don't use __ attributes in UnixConsole
     def flushoutput(self):
-        for text, iscode in self._UnixConsole__buffer:
-            self._terminal.feed(text.encode(self.encoding))
+        self._terminal.feed("".join(text.encode(self.encoding)
+                                    for text, iscode
+                                    in self._UnixConsole__buffer))
         del self._UnixConsole__buffer[:]
 
     def _update_size(self):
@@ -71,20 +136,6 @@ class JobMessageOutput(object):
         self._terminal.feed(data.replace("\n", "\n\r"))
 
 
-def forward_output_to_terminal(master_fd, terminal):
-    def on_avail(*args):
-        try:
-            data = os.read(master_fd.fileno(), 1024)
-        except OSError:
-            return False
-        else:
-            terminal.feed(data)
-            return len(data) > 0
-    gobject.io_add_watch(
-        master_fd.fileno(), gobject.IO_IN | gobject.IO_HUP | gobject.IO_NVAL,
-        on_avail)
-
-
 def set_terminal_size(tty_fd, width, height):
     fcntl.ioctl(tty_fd, termios.TIOCSWINSZ,
                 struct.pack("HHHH", height, width, 0, 0))
@@ -119,16 +170,62 @@ VTE_ERASE_DELETE_SEQUENCE = 3
 VTE_ERASE_TTY = 4
 
 
-class TerminalWidget(object):
+# Keeps one TerminalWidget constructed in advance, so that opening a
+# tab or window does not have to wait for VTE, the shell and the
+# reader to be set up.  The spare is created when the main loop is
+# idle.  parts contains the state that is shared between tabs.
+class SpareTerminal(object):
 
     def __init__(self, parts):
+        self._parts = parts
+        self._spare = None
+        self._scheduled = False
+        self._schedule()
+
+    def _schedule(self):
+        if self._spare is None and not self._scheduled:
+            self._scheduled = True
+            gobject.idle_add(self._create, priority=gobject.PRIORITY_LOW)
+
+    def _make(self):
+        # make_shell() adds to the parts dict, so each widget needs
+        # its own copy.
+        return TerminalWidget(dict(self._parts), start=False)
+
+    def _create(self):
+        self._scheduled = False
+        if self._spare is None:
+            self._spare = self._make()
+        # Remove the idle handler.
+        return False
+
+    # Returns a widget that has not been started yet.
+    def get(self):
+        widget = self._spare
+        self._spare = None
+        if widget is None:
+            widget = self._make()
+        self._schedule()
+        return widget
+
+
+class TerminalWidget(object):
+
+    # If start is False, the widget does not show a prompt until
+    # start() is called.
+    def __init__(self, parts, start=True):
         self._terminal = vte.Terminal()
         # set_pty() seems to set up backspace, but we're not using it.
         # Need ASCII_DELETE rather than ASCII_BACKSPACE if we want
         # Alt-Backspace to work.
         self._terminal.set_backspace_binding(VTE_ERASE_ASCII_DELETE)
-        self._writer = JobMessageOutput(self._terminal)
-        self._console = VTEConsole(self._terminal)
+        # All output goes through the feeder so that it stays in order.
+        self._feeder = terminal_output.OutputFeeder(self._terminal.feed)
+        self._writer = JobMessageOutput(self._feeder)
+        self._console = VTEConsole(self._feeder)
+        self._scrollback = terminal_scrollback.Scrollback()
+        self._pty_pool = PtyPool()
+        self._feeder.add_output_handler(self._scrollback.append)
         self.title = shell_event.ObservableCell("")
         parts["job_output"] = self._writer
         parts["job_tty"] = None
@@ -139,12 +236,27 @@ class TerminalWidget(object):
         parts.setdefault("real_cwd", shell.LocalCwdTracker())
         self._shell = shell.Shell(parts)
         self._reader = shell_pyrepl.Reader(
-            self._shell.get_prompt, self._shell.completer, self._console)
+            self._shell.get_prompt, self._shell.completer, self._console,
+            self._shell.get_recall_list, self._shell.get_suggestion,
+            self._shell.stream_completer)
+        self._shell.add_prompt_update_handler(self._reader.redraw_prompt)
         self._current_reader = None
         self._current_resizer = lambda: None
+        self._current_silencer = None
         self._read_pending = lambda: None
-        self._read_input()
+        if start:
+            self._read_input()
         self._shell.job_controller.add_done_handler(self._job_done)
+        if "spare_terminal" not in parts:
+            shared_parts = {"history": self._shell.history,
+                            "output_store": self._shell.output_store,
+                            "executable_index": self._shell.executable_index,
+                            "directory_cache": self._shell.directory_cache,
+                            "fuzzy_completion":
+                                self._shell.fuzzy_completion}
+            shared_parts["spare_terminal"] = SpareTerminal(shared_parts)
+            parts["spare_terminal"] = shared_parts["spare_terminal"]
+        self._spare_terminal = parts["spare_terminal"]
 
         self._terminal.connect("commit", self._on_user_input)
         self._terminal.connect("size_allocate", self._on_size_change)
@@ -163,13 +275,23 @@ class TerminalWidget(object):
         self._hbox.show_all()
         self._on_finished = shell_event.EventDistributor()
         self.add_finished_handler = self._on_finished.add
+        self.add_finished_handler(self._scrollback.close)
+        self.add_finished_handler(self._pty_pool.close)
         self._on_attention = shell_event.EventDistributor()
         self.add_attention_handler = self._on_attention.add
 
     def clone(self):
-        return TerminalWidget({"environ": self._shell.environ.copy(),
-                               "real_cwd": self._shell.real_cwd.copy(),
-                               "history": self._shell.history})
+        widget = self._spare_terminal.get()
+        widget.start(self._shell.environ, self._shell.real_cwd.get_cwd_fd())
+        return widget
+
+    # Takes on the given environment and cwd, and shows the prompt.
+    def start(self, environ, cwd_fd):
+        self._shell.environ.clear()
+        self._shell.environ.update(environ)
+        self._shell.real_cwd.set_cwd_fd(cwd_fd)
+        self._shell.cwd.invalidate()
+        self._read_input()
 
     def set_hints(self, window):
         pad_x, pad_y = self._terminal.get_padding()
@@ -193,10 +315,12 @@ class TerminalWidget(object):
 
     def _read_input(self):
         self._shell.job_controller.print_messages()
+        self._shell.history.poll()
         self._reader.prepare()
         self._reader.refresh()
         self._current_reader = self._on_readline_input
         self._current_resizer = lambda: None
+        self._current_silencer = None
         self.title.set(self._shell.get_title())
 
     def _on_user_input(self, widget_unused, data, size):
@@ -228,13 +352,32 @@ class TerminalWidget(object):
             self._process_input(self._reader.get_buffer())
 
     def _process_input(self, line):
-        master_fd, slave_fd = openpty()
-        # Setting O_NONBLOCK shouldn't be necessary, but poll() will
-        # sometimes report the FD as ready to read when reading it
-        # will block.
-        fcntl.fcntl(master_fd, fcntl.F_SETFL,
-                    fcntl.fcntl(master_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
-        forward_output_to_terminal(master_fd, self._terminal)
+        master_fd, slave_fd = self._pty_pool.get()
+        job_output = jobcontrol.OutputRing()
+        # Output from jobs sent to the background is only kept in
+        # job_output.
+        silenced = [False]
+        if self._shell.output_store is not None:
+            recording = self._shell.output_store.start_recording(
+                line, self._terminal.get_column_count(),
+                self._terminal.get_row_count())
+        else:
+            recording = None
+
+        def on_output(data):
+            job_output.write(data)
+            if recording is not None:
+                recording.write(data)
+
+        def on_close():
+            if recording is not None:
+                recording.close()
+
+        def silence():
+            silenced[0] = True
+
+        self._feeder.forward(master_fd, on_output, on_close,
+                             lambda: silenced[0])
 
         def on_input(data):
             os.write(master_fd.fileno(), data)
@@ -244,19 +387,15 @@ class TerminalWidget(object):
                               self._terminal.get_row_count())
 
         def to_foreground():
+            silenced[0] = False
             self._current_reader = on_input
             self._current_resizer = update_size
+            self._current_silencer = silence
             update_size()
 
         def read_pending():
-            # Read pending data in case we received the process's exit
-            # status before reading from the tty in the main loop.
-            try:
-                data = os.read(master_fd.fileno(), 4096)
-            except OSError:
-                pass
-            else:
-                self._terminal.feed(data)
+            self._feeder.read_pending(master_fd, on_output,
+                                      lambda: silenced[0])
 
         fds = {0: slave_fd, 1: slave_fd, 2: slave_fd}
         to_foreground()
@@ -264,23 +403,129 @@ class TerminalWidget(object):
         self._read_pending = read_pending
         job_spawner = jobcontrol.SessionJobSpawner(
             self._shell.wait_dispatcher, self._shell.job_controller, slave_fd,
-            to_foreground)
+            to_foreground, job_output)
         self._shell.job_controller.stop_waiting()
+        history_id = None
         try:
-            self._shell.run_job_command(line, fds, job_spawner)
+            history_id = self._shell.run_job_command(line, fds, job_spawner)
         except Exception:
             self._writer.write("".join(traceback.format_exc()))
+        if recording is not None:
+            recording.set_history_id(history_id)
         self._shell.job_controller.check_for_done()
 
+    # Output for hidden tabs is buffered rather than rendered.
+    def set_visible(self, visible):
+        self._feeder.set_visible(visible)
+
     def _job_done(self):
         self._on_attention.send()
         self._read_pending()
         self._read_input()
 
+    def _job_to_background(self, *args):
+        if self._current_silencer is not None:
+            self._current_silencer()
+            self._writer.write('Job output silenced.  '
+                               'Use "jobs -o ID" to show it.\n')
+        self._read_input()
+
     def get_menu_items(self):
         item = gtk.MenuItem("Job To Background")
-        item.connect("activate", lambda *args: self._read_input())
-        return [item]
+        item.connect("activate", self._job_to_background)
+        search_item = gtk.MenuItem("_Search Scrollback")
+        search_item.connect(
+            "activate",
+            lambda *args: ScrollbackSearch(self._scrollback,
+                                           self.title.get()).show())
+        return [item, search_item]
+
+
+# Number of lines shown around a selected search result.
+SEARCH_CONTEXT_LINES = 10
+
+
+class ScrollbackSearch(object):
+
+    def __init__(self, scrollback, title):
+        self._scrollback = scrollback
+        self._snapshot = None
+        # Used to ignore results from searches that have been replaced.
+        self._generation = 0
+        self._window = gtk.Window()
+        self._window.set_title("Search: %s" % title)
+        self._window.set_default_size(700, 500)
+        self._entry = gtk.Entry()
+        self._entry.connect("activate", self._on_search)
+        self._status = gtk.Label()
+        self._status.set_alignment(0, 0.5)
+        self._results = gtk.ListStore(int, str)
+        results_view = gtk.TreeView(self._results)
+        for index, name in enumerate(["Line", "Text"]):
+            results_view.append_column(gtk.TreeViewColumn(
+                    name, gtk.CellRendererText(), text=index))
+        results_view.connect("cursor_changed", self._on_select)
+        self._context = gtk.TextView()
+        self._context.set_editable(False)
+        self._context.modify_font(pango.FontDescription("monospace"))
+        vbox = gtk.VBox()
+        vbox.pack_start(self._entry, expand=False)
+        vbox.pack_start(self._status, expand=False)
+        paned = gtk.VPaned()
+        for widget in (results_view, self._context):
+            scrolled = gtk.ScrolledWindow()
+            scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+            scrolled.add(widget)
+            paned.add(scrolled)
+        vbox.pack_start(paned, expand=True, fill=True)
+        self._window.add(vbox)
+
+    def show(self):
+        self._window.show_all()
+
+    def _on_search(self, *args):
+        try:
+            regexp = re.compile(self._entry.get_text())
+        except re.error, exn:
+            self._status.set_text("Bad regular expression: %s" % exn)
+            return
+        self._generation += 1
+        generation = self._generation
+        self._snapshot = self._scrollback.get_snapshot()
+        snapshot = self._snapshot
+        self._results.clear()
+        self._status.set_text("Searching...")
+        def callback(results):
+            if generation == self._generation:
+                self._show_results(results)
+        shell_worker.get_default_pool().call(
+            lambda: snapshot.search(regexp), callback)
+
+    def _show_results(self, results):
+        if results is None:
+            self._status.set_text("Search failed")
+            return
+        for line_number, text in results:
+            self._results.append((line_number + 1, text))
+        message = "%i matches" % len(results)
+        if len(results) >= terminal_scrollback.MAX_SEARCH_RESULTS:
+            message = "First " + message
+        self._status.set_text(message)
+
+    def _on_select(self, tree_view):
+        path, column = tree_view.get_cursor()
+        if path is None or self._snapshot is None:
+            return
+        line_number = self._results[path][0] - 1
+        start = max(line_number - SEARCH_CONTEXT_LINES, 0)
+        snapshot = self._snapshot
+        generation = self._generation
+        def callback(lines):
+            if generation == self._generation and lines is not None:
+                self._context.get_buffer().set_text("\n".join(lines))
+        shell_worker.get_default_pool().call(
+            lambda: snapshot.get_lines(start, 2 * SEARCH_CONTEXT_LINES + 1),
+            callback)
 
 
 # Alert the user to completed commands that occur this much time after
@@ -346,6 +591,8 @@ class TerminalWindow(object):
 
     def _on_switch_tab(self, unused1, unused2, index):
         tab = self._tab_map[self._tabset.get_nth_page(index)]
+        for other_tab in self._tab_map.itervalues():
+            other_tab["terminal"].set_visible(other_tab is tab)
         tab["clear_attention"]()
         self._title.set(tab["terminal"].title)
         self._window.set_urgency_hint(False)
@@ -428,13 +675,109 @@ def make_terminal(parts):
     return TerminalWindow(TerminalWidget(parts))
 
 
+# Listens for requests from terminal_client.py to open windows.
+# open_window(cwd, environ) is called for each request.
+class TerminalServer(object):
+
+    def __init__(self, socket_path, open_window):
+        self._socket_path = socket_path
+        self._open_window = open_window
+        self._sock = None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error, exn:
+            if exn.errno == errno.ECONNREFUSED:
+                # Left behind by a terminal that did not exit cleanly.
+                os.unlink(socket_path)
+            elif exn.errno != errno.ENOENT:
+                raise
+        else:
+            # Another terminal is already serving requests.
+            sock.close()
+            return
+        sock.close()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(socket_path)
+        self._sock.listen(5)
+        gobject.io_add_watch(self._sock.fileno(), gobject.IO_IN,
+                             self._on_connection)
+
+    def _on_connection(self, *args):
+        conn, addr = self._sock.accept()
+        conn.setblocking(False)
+        chunks = []
+        # Read the request without blocking the main loop, in case
+        # the client is slow.
+        def on_data(*args):
+            try:
+                data = conn.recv(4096)
+            except socket.error, exn:
+                if exn.errno == errno.EAGAIN:
+                    return True
+                conn.close()
+                return False
+            if len(data) > 0:
+                chunks.append(data)
+                return True
+            reply = self._handle_request("".join(chunks))
+            conn.setblocking(True)
+            try:
+                conn.sendall(reply)
+            except socket.error:
+                pass
+            conn.close()
+            return False
+        gobject.io_add_watch(conn.fileno(), gobject.IO_IN | gobject.IO_HUP,
+                             on_data)
+        return True
+
+    def _handle_request(self, data):
+        try:
+            cwd, environ = terminal_client.decode_request(data)
+            self._open_window(cwd, environ)
+        except Exception, exn:
+            traceback.print_exc()
+            return "error: %s\n" % exn
+        return "ok\n"
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            os.unlink(self._socket_path)
+            self._sock = None
+
+
+def open_window(spare_terminal, cwd, environ):
+    # Our windows can only appear on the display we were started on.
+    if environ.get("DISPLAY") != os.environ.get("DISPLAY"):
+        raise Exception("Terminal is running on a different display")
+    cwd_fd = shell.FDWrapper(os.open(cwd, os.O_RDONLY | os.O_DIRECTORY))
+    environ = environ.copy()
+    environ["TERM"] = "xterm"
+    widget = spare_terminal.get()
+    widget.start(environ, cwd_fd)
+    TerminalWindow(widget).get_widget().show_all()
+
+
 def main():
     signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    socket_path = terminal_client.get_socket_path()
+    if terminal_client.send_request(os.getcwd(), os.environ, socket_path):
+        return
     gtk.window_set_default_icon_name("gnome-terminal")
-    parts = {"history": shell.History()}
+    parts = {"history": shell.History(),
+             "output_store": shell.make_output_store(),
+             "executable_index": shell.make_persistent_executable_index()}
     make_terminal(parts).get_widget().show_all()
+    server = TerminalServer(
+        socket_path, lambda cwd, environ: open_window(
+            parts["spare_terminal"], cwd, environ))
     errorgui.set_excepthook()
-    gtk.main()
+    try:
+        gtk.main()
+    finally:
+        server.close()
 
 
 if __name__ == "__main__":
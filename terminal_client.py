@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Quick launcher for the terminal.  If a terminal process is already
+# running, this asks it to open a window with our cwd and environment,
+# which avoids the cost of starting Python with GTK and VTE.
+# Otherwise it starts terminal.py, which then listens for requests.
+#
+# This must not import gtk, or anything else that is slow to load.
+#
+# Protocol: the client sends a JSON object with "cwd" and "environ",
+# then shuts down its side of the connection.  The server replies
+# "ok" or "error: <message>".  Strings are decoded as Latin-1 so that
+# any bytes can be passed through JSON.
+
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+
+
+# Timeout for connecting to the server and getting its reply.
+REQUEST_TIMEOUT = 5 # seconds
+
+
+def get_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir is None:
+        runtime_dir = "/tmp/coconut-shell-%i" % os.getuid()
+        try:
+            os.mkdir(runtime_dir, 0700)
+        except OSError, exn:
+            if exn.errno != errno.EEXIST:
+                raise
+        # Don't use a directory that another user has created for us.
+        st = os.lstat(runtime_dir)
+        if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            stat.S_IMODE(st.st_mode) & 0077 != 0):
+            raise Exception("Unsafe directory: %r" % runtime_dir)
+    return os.path.join(runtime_dir, "coconut-terminal.socket")
+
+
+def encode_request(cwd, environ):
+    return json.dumps({"cwd": cwd.decode("latin-1"),
+                       "environ": dict((key.decode("latin-1"),
+                                        value.decode("latin-1"))
+                                       for key, value in environ.iteritems())})
+
+
+def decode_request(data):
+    request = json.loads(data)
+    return (request["cwd"].encode("latin-1"),
+            dict((key.encode("latin-1"), value.encode("latin-1"))
+                 for key, value in request["environ"].iteritems()))
+
+
+# Returns True if a running terminal opened a window for us.
+def send_request(cwd, environ, socket_path=None):
+    if socket_path is None:
+        socket_path = get_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(REQUEST_TIMEOUT)
+    try:
+        try:
+            sock.connect(socket_path)
+            sock.sendall(encode_request(cwd, environ))
+            sock.shutdown(socket.SHUT_WR)
+            reply = []
+            while True:
+                data = sock.recv(4096)
+                if len(data) == 0:
+                    break
+                reply.append(data)
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+    reply = "".join(reply)
+    if reply.startswith("ok"):
+        return True
+    sys.stderr.write("terminal: %s\n" % reply.strip())
+    return False
+
+
+def main(args):
+    if not send_request(os.getcwd(), os.environ):
+        terminal_path = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "terminal.py")
+        os.execv(sys.executable, [sys.executable, terminal_path] + args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
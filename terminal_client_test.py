@@ -0,0 +1,69 @@
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+import os
+import socket
+import threading
+import unittest
+
+import tempdir_test
+import terminal_client
+
+
+class TerminalClientTest(tempdir_test.TempDirTestCase):
+
+    def test_request_encoding(self):
+        environ = {"FOO": "bar", "BYTES": "\xff\xfe"}
+        cwd, environ2 = terminal_client.decode_request(
+            terminal_client.encode_request("/tmp/\xe9", environ))
+        self.assertEquals(cwd, "/tmp/\xe9")
+        self.assertEquals(environ2, environ)
+        assert all(isinstance(key, str) for key in environ2)
+
+    def test_no_server(self):
+        socket_path = os.path.join(self.make_temp_dir(), "socket")
+        self.assertFalse(terminal_client.send_request(
+                "/", {}, socket_path=socket_path))
+
+    def test_sending_request(self):
+        socket_path = os.path.join(self.make_temp_dir(), "socket")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(socket_path)
+        sock.listen(1)
+        requests = []
+        def serve():
+            conn, addr = sock.accept()
+            data = []
+            while True:
+                chunk = conn.recv(4096)
+                if len(chunk) == 0:
+                    break
+                data.append(chunk)
+            requests.append(terminal_client.decode_request("".join(data)))
+            conn.sendall("ok\n")
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        self.assertTrue(terminal_client.send_request(
+                "/some/dir", {"A": "b"}, socket_path=socket_path))
+        thread.join()
+        sock.close()
+        self.assertEquals(requests, [("/some/dir", {"A": "b"})])
+
+
+if __name__ == "__main__":
+    unittest.main()
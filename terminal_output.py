@@ -0,0 +1,231 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Batching output from ptys before passing it to the terminal widget.
+# Each feed() makes VTE reprocess and redraw, so feeding every small
+# read separately makes fast-scrolling output very slow.
+#
+# A job that writes as fast as it can (such as "yes") would still keep
+# the main loop busy in VTE.  When output arrives faster than
+# FLOOD_RATE we switch to flood mode: the pty is drained at full
+# speed, but only the last FLOOD_KEEP bytes of each frame are passed
+# on, and frames are less frequent.  Normal mode resumes when the rate
+# drops.
+#
+# Output for tabs that are not visible is not passed on at all.  It is
+# kept, up to HIDDEN_KEEP bytes, until the tab is shown.
+
+import errno
+import os
+import time
+
+import gobject
+
+import shell_event
+import shell_worker
+
+
+# Output from ptys is passed on at most this often.
+FRAME_INTERVAL = 0.016 # seconds
+
+READ_SIZE = 65536
+
+# Stop reading from ptys when this much output is waiting to be
+# passed on.  The producer then blocks until the next frame.
+MAX_PENDING = 1 << 20
+
+# The output rate is measured over periods of this length.
+FLOOD_WINDOW = 0.25 # seconds
+# Flood mode starts above this rate, and ends below a quarter of it.
+FLOOD_RATE = 4 << 20 # bytes per second
+# Enough for the last screenful plus some scrollback.
+FLOOD_KEEP = 64 * 1024
+FLOOD_FRAME_INTERVAL = 0.1 # seconds
+
+HIDDEN_KEEP = 256 * 1024
+
+READ_BLOCKED, READ_MORE, READ_EOF = range(3)
+
+
+# Returns the end of the output, starting at a line boundary so that
+# we don't pass on part of an escape sequence.
+def get_tail(data, size):
+    if len(data) <= size:
+        return data
+    tail = data[-size:]
+    index = tail.find("\n")
+    if index == -1:
+        return tail
+    return tail[index + 1:]
+
+
+class OutputFeeder(object):
+
+    def __init__(self, feed, get_time=time.time):
+        self._feed = feed
+        self._get_time = get_time
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = 0
+        self._flush_timer = None
+        # Functions to restart reading from ptys that we stopped
+        # watching because too much output was pending.
+        self._paused = []
+        self._window_start = get_time()
+        self._window_size = 0
+        self.flooding = False
+        self._visible = True
+        # Output handlers get all output, including output that is
+        # dropped in flood mode or while hidden.
+        self._on_output = shell_event.EventDistributor()
+        self.add_output_handler = self._on_output.add
+
+    def set_visible(self, visible):
+        self._visible = visible
+        if visible:
+            self.flush()
+
+    # Output from the shell itself (such as the prompt) is passed on
+    # immediately, after any buffered output from jobs.
+    def feed(self, data):
+        self._on_output.send(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        self.flush()
+
+    def flush(self):
+        if self._flush_timer is not None:
+            gobject.source_remove(self._flush_timer)
+            self._flush_timer = None
+        if not self._visible:
+            if self._pending_size > HIDDEN_KEEP:
+                self._trim_pending(HIDDEN_KEEP)
+        elif len(self._pending) > 0:
+            data = "".join(self._pending)
+            if self.flooding:
+                data = get_tail(data, FLOOD_KEEP)
+            self._pending = []
+            self._pending_size = 0
+            self._feed(data)
+        self._last_flush = self._get_time()
+        paused = self._paused
+        self._paused = []
+        for resume in paused:
+            resume()
+        # Remove the timeout handler.
+        return False
+
+    def _schedule_flush(self):
+        if self._flush_timer is None and self._visible:
+            if self.flooding:
+                interval = FLOOD_FRAME_INTERVAL
+            else:
+                interval = FRAME_INTERVAL
+            delay = self._last_flush + interval - self._get_time()
+            if delay <= 0:
+                self.flush()
+            else:
+                self._flush_timer = gobject.timeout_add(
+                    int(delay * 1000) + 1, self.flush)
+
+    def _count_output(self, size):
+        self._window_size += size
+        now = self._get_time()
+        elapsed = now - self._window_start
+        if elapsed >= FLOOD_WINDOW:
+            rate = self._window_size / elapsed
+            if rate >= FLOOD_RATE:
+                self.flooding = True
+            elif rate < FLOOD_RATE / 4:
+                self.flooding = False
+            self._window_start = now
+            self._window_size = 0
+
+    # Discards all but the end of the pending output.
+    def _trim_pending(self, size):
+        data = get_tail("".join(self._pending), size)
+        self._pending = [data]
+        self._pending_size = len(data)
+
+    # Reads until the pty would block, or until MAX_PENDING bytes have
+    # been read so that other event sources get a turn.  Returns
+    # READ_BLOCKED, READ_MORE or READ_EOF.  on_output is called with
+    # the output from this pty.  The output is not passed on to the
+    # terminal while is_silenced() returns True.
+    def _read_available(self, fd, on_output, is_silenced):
+        read_size = 0
+        while self._pending_size < MAX_PENDING and read_size < MAX_PENDING:
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError, exn:
+                if exn.errno == errno.EAGAIN:
+                    return READ_BLOCKED
+                # We get EIO when the slave side has been closed.
+                return READ_EOF
+            if len(data) == 0:
+                return READ_EOF
+            on_output(data)
+            # Output from silenced jobs counts towards the limit too,
+            # so that a busy background job can't hog the main loop.
+            read_size += len(data)
+            if is_silenced():
+                continue
+            self._on_output.send(data)
+            self._pending.append(data)
+            self._pending_size += len(data)
+            self._count_output(len(data))
+            if not self._visible:
+                if self._pending_size > HIDDEN_KEEP:
+                    self._trim_pending(HIDDEN_KEEP)
+            elif self._pending_size >= MAX_PENDING and self.flooding:
+                self._trim_pending(FLOOD_KEEP)
+        return READ_MORE
+
+    # Forwards output from a non-blocking pty master FD.  on_close is
+    # called at end of file.
+    def forward(self, master_fd, on_output=lambda data: None,
+                on_close=lambda: None, is_silenced=lambda: False):
+        fd = master_fd.fileno()
+        def on_avail(*args):
+            result = self._read_available(fd, on_output, is_silenced)
+            if result == READ_MORE:
+                resume = lambda: self.forward(master_fd, on_output, on_close,
+                                              is_silenced)
+                if self.flooding or not self._visible:
+                    # Keep draining the pty, but let redraws and
+                    # other idle handlers run first.
+                    gobject.idle_add(shell_worker.call_once, resume,
+                                     priority=gobject.PRIORITY_LOW)
+                else:
+                    # Wait until the pending output has been passed on.
+                    self._paused.append(resume)
+            elif result == READ_EOF:
+                on_close()
+            self._schedule_flush()
+            return result == READ_BLOCKED
+        gobject.io_add_watch(
+            fd, gobject.IO_IN | gobject.IO_HUP | gobject.IO_NVAL, on_avail)
+
+    # Passes on all output that can be read without blocking, in case
+    # we received a job's exit status before reading from its pty.
+    def read_pending(self, master_fd, on_output=lambda data: None,
+                     is_silenced=lambda: False):
+        while (self._read_available(master_fd.fileno(), on_output,
+                                    is_silenced) == READ_MORE):
+            self.flush()
+        self.flush()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Measures how fast output from a pty is consumed, without a GUI.
+#
+# Usage: terminal_output_benchmark.py [--megabytes N] [--unbatched] [--vte]
+#
+# --unbatched reads 1024 bytes per wakeup and feeds each read
+# separately, as the terminal used to.  --vte feeds the output into a
+# VTE widget (which needs a display) instead of discarding it.
+
+import fcntl
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+import gobject
+
+import terminal_output
+
+
+PRODUCER = """
+import os, sys
+line = "".join(chr(ord("a") + i %% 26) for i in range(79)) + "\\n"
+block = line * 1000
+for i in xrange(%i * 1024 * 1024 // len(block)):
+    os.write(1, block)
+"""
+
+
+def forward_unbatched(master_fd, feed):
+    def on_avail(*args):
+        try:
+            data = os.read(master_fd.fileno(), 1024)
+        except OSError:
+            return False
+        feed(data)
+        return len(data) > 0
+    gobject.io_add_watch(
+        master_fd.fileno(), gobject.IO_IN | gobject.IO_HUP | gobject.IO_NVAL,
+        on_avail)
+
+
+def main(args):
+    parser = optparse.OptionParser()
+    parser.add_option("--megabytes", dest="megabytes", type="int",
+                      default=100)
+    parser.add_option("--unbatched", dest="unbatched", action="store_true",
+                      default=False)
+    parser.add_option("--vte", dest="vte", action="store_true",
+                      default=False)
+    options, args = parser.parse_args(args)
+    counts = {"bytes": 0, "feeds": 0}
+    if options.vte:
+        import vte
+        terminal = vte.Terminal()
+        def feed(data):
+            counts["bytes"] += len(data)
+            counts["feeds"] += 1
+            terminal.feed(data)
+    else:
+        def feed(data):
+            counts["bytes"] += len(data)
+            counts["feeds"] += 1
+    master, slave = os.openpty()
+    master_fd = os.fdopen(master, "r", 0)
+    fcntl.fcntl(master, fcntl.F_SETFL,
+                fcntl.fcntl(master, fcntl.F_GETFL) | os.O_NONBLOCK)
+    start_time = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, "-c", PRODUCER % options.megabytes],
+        stdout=slave)
+    os.close(slave)
+    if options.unbatched:
+        forward_unbatched(master_fd, feed)
+    else:
+        feeder = terminal_output.OutputFeeder(feed)
+        feeder.forward(master_fd)
+    while proc.poll() is None:
+        gobject.main_context_default().iteration(True)
+    if options.unbatched:
+        while True:
+            try:
+                data = os.read(master, 1024)
+            except OSError:
+                break
+            if len(data) == 0:
+                break
+            feed(data)
+    else:
+        feeder.read_pending(master_fd)
+    duration = time.time() - start_time
+    print "%.1f MB in %.2fs: %.1f MB/s, %i feeds" % (
+        counts["bytes"] / 1e6, duration, counts["bytes"] / 1e6 / duration,
+        counts["feeds"])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
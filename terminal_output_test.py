@@ -0,0 +1,133 @@
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+import fcntl
+import os
+import unittest
+
+import terminal_output
+
+
+def make_nonblocking_pipe():
+    read_fd, write_fd = os.pipe()
+    fcntl.fcntl(read_fd, fcntl.F_SETFL,
+                fcntl.fcntl(read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return os.fdopen(read_fd, "r", 0), write_fd
+
+
+class OutputFeederTest(unittest.TestCase):
+
+    def test_pending_output_fed_in_one_call(self):
+        fed = []
+        feeder = terminal_output.OutputFeeder(fed.append)
+        read_fd, write_fd = make_nonblocking_pipe()
+        for i in range(100):
+            os.write(write_fd, "line %i\n" % i)
+        feeder.read_pending(read_fd)
+        self.assertEquals(fed, ["".join("line %i\n" % i
+                                        for i in range(100))])
+        os.close(write_fd)
+        read_fd.close()
+
+    def test_job_output_precedes_shell_output(self):
+        fed = []
+        feeder = terminal_output.OutputFeeder(fed.append)
+        read_fd, write_fd = make_nonblocking_pipe()
+        os.write(write_fd, "job output\n")
+        feeder._read_available(read_fd.fileno(), lambda data: None,
+                               lambda: False)
+        self.assertEquals(fed, [])
+        feeder.feed("$ ")
+        self.assertEquals(fed, ["job output\n$ "])
+        os.close(write_fd)
+        read_fd.close()
+
+    def test_silenced_output_counts_towards_read_limit(self):
+        feeder = terminal_output.OutputFeeder(lambda data: None)
+        read_fd, write_fd = make_nonblocking_pipe()
+        os.write(write_fd, "x" * 100)
+        got = []
+        old_max_pending = terminal_output.MAX_PENDING
+        terminal_output.MAX_PENDING = 10
+        try:
+            self.assertEquals(
+                feeder._read_available(read_fd.fileno(), got.append,
+                                       lambda: True),
+                terminal_output.READ_MORE)
+        finally:
+            terminal_output.MAX_PENDING = old_max_pending
+        self.assertEquals(got, ["x" * 100])
+        os.close(write_fd)
+        read_fd.close()
+
+    def test_get_tail(self):
+        self.assertEquals(terminal_output.get_tail("abc", 10), "abc")
+        self.assertEquals(terminal_output.get_tail("a\nbc\nde", 5), "de")
+        self.assertEquals(terminal_output.get_tail("abcdef", 2), "ef")
+
+    def test_flood_mode(self):
+        fed = []
+        now = [0]
+        feeder = terminal_output.OutputFeeder(fed.append,
+                                              get_time=lambda: now[0])
+        now[0] = 1.0
+        feeder._count_output(terminal_output.FLOOD_RATE)
+        self.assertTrue(feeder.flooding)
+        lines = ["line %i\n" % i for i in range(100000)]
+        feeder.feed("".join(lines))
+        self.assertTrue(len(fed[0]) <= terminal_output.FLOOD_KEEP)
+        self.assertTrue(fed[0].startswith("line "))
+        self.assertTrue(fed[0].endswith(lines[-1]))
+        now[0] = 2.0
+        feeder._count_output(100)
+        self.assertFalse(feeder.flooding)
+        feeder.feed("".join(lines))
+        self.assertEquals(fed[1], "".join(lines))
+
+    def test_hidden_output_kept_until_visible(self):
+        fed = []
+        feeder = terminal_output.OutputFeeder(fed.append)
+        feeder.set_visible(False)
+        feeder.feed("foo\n")
+        feeder.feed("bar\n")
+        self.assertEquals(fed, [])
+        feeder.set_visible(True)
+        self.assertEquals(fed, ["foo\nbar\n"])
+
+    def test_hidden_output_is_bounded(self):
+        fed = []
+        feeder = terminal_output.OutputFeeder(fed.append)
+        feeder.set_visible(False)
+        lines = ["line %i\n" % i for i in range(200000)]
+        feeder.feed("".join(lines))
+        self.assertTrue(feeder._pending_size <= terminal_output.HIDDEN_KEEP)
+        read_fd, write_fd = make_nonblocking_pipe()
+        for i in range(10):
+            os.write(write_fd, "".join(lines[:6000]))
+            feeder._read_available(read_fd.fileno(), lambda data: None,
+                                   lambda: False)
+            self.assertTrue(
+                feeder._pending_size <= terminal_output.HIDDEN_KEEP)
+        os.close(write_fd)
+        read_fd.close()
+        feeder.set_visible(True)
+        self.assertTrue(len(fed[0]) <= terminal_output.HIDDEN_KEEP)
+        self.assertTrue(fed[0].endswith(lines[5999]))
+
+
+if __name__ == "__main__":
+    unittest.main()
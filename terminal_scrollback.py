@@ -0,0 +1,176 @@
+
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Unlimited scrollback for a terminal tab, kept on disk.
+#
+# Output is collected in memory until there is CHUNK_SIZE of it, then
+# the complete lines are compressed and appended to a temporary file.
+# For each chunk we record its offset in the file and the number of
+# its first line, so memory use does not depend on the amount of
+# output, apart from a few bytes per chunk.
+#
+# Searching and reading lines can be done from a worker thread.  They
+# work on a snapshot of the index and read the file through mmap.
+
+import array
+import bisect
+import mmap
+import re
+import tempfile
+import zlib
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Lines longer than this are split so that chunks stay bounded.
+MAX_LINE_LENGTH = 1 << 20
+
+COMPRESS_LEVEL = 1
+
+MAX_SEARCH_RESULTS = 1000
+
+# CSI and OSC sequences, and other two-character escapes.
+ESCAPE_REGEXP = re.compile(r"\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*"
+                           r"(\x07|\x1b\\)?|[ -/]*[0-~])")
+# Text that was overwritten after a carriage return.
+OVERWRITTEN_REGEXP = re.compile(r"^[^\n]*\r", re.MULTILINE)
+
+
+# Removes escape sequences and overwritten text, leaving roughly what
+# was displayed.
+def get_plain_text(data):
+    data = ESCAPE_REGEXP.sub("", data)
+    data = data.replace("\r\n", "\n")
+    if "\r" not in data:
+        return data
+    return OVERWRITTEN_REGEXP.sub("", data)
+
+
+class Snapshot(object):
+
+    # tail is the output that has not been written to the file yet,
+    # starting at line number tail_first_line.
+    def __init__(self, fileno, offsets, first_lines, file_size,
+                 tail, tail_first_line):
+        self.fileno = fileno
+        self.offsets = offsets
+        self.first_lines = first_lines
+        self.file_size = file_size
+        self.tail = tail
+        self.tail_first_line = tail_first_line
+
+    # Yields (number of first line, plain text) for each chunk, with
+    # the text ending in a newline.
+    def _iter_chunks(self, start_index=0):
+        if self.file_size > 0:
+            mapping = mmap.mmap(self.fileno, self.file_size,
+                                access=mmap.ACCESS_READ)
+            try:
+                offsets = list(self.offsets) + [self.file_size]
+                for index in xrange(start_index, len(self.offsets)):
+                    data = zlib.decompress(
+                        mapping[offsets[index]:offsets[index + 1]])
+                    yield self.first_lines[index], get_plain_text(data)
+            finally:
+                mapping.close()
+        tail = get_plain_text(self.tail)
+        if not tail.endswith("\n"):
+            tail += "\n"
+        yield self.tail_first_line, tail
+
+    # Returns a list of (line number, text) for lines matching the
+    # compiled regexp.
+    def search(self, regexp, max_results=MAX_SEARCH_RESULTS):
+        results = []
+        # Most chunks contain no matches, so check the whole chunk
+        # before splitting it into lines.
+        chunk_regexp = re.compile(regexp.pattern,
+                                  regexp.flags | re.MULTILINE)
+        for first_line, text in self._iter_chunks():
+            if chunk_regexp.search(text) is None:
+                continue
+            for index, line in enumerate(text[:-1].split("\n")):
+                if regexp.search(line) is not None:
+                    results.append((first_line + index, line))
+                    if len(results) >= max_results:
+                        return results
+        return results
+
+    # Returns up to count lines starting from line number start.
+    def get_lines(self, start, count):
+        index = max(bisect.bisect_right(self.first_lines, start) - 1, 0)
+        lines = []
+        for first_line, text in self._iter_chunks(index):
+            chunk_lines = text[:-1].split("\n")
+            lines.extend(chunk_lines[max(start - first_line, 0):])
+            if len(lines) >= count:
+                break
+        return lines[:count]
+
+
+class Scrollback(object):
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self._chunk_size = chunk_size
+        # The file is deleted as soon as it is created, so it goes
+        # away when we exit.
+        self._file = tempfile.TemporaryFile(prefix="terminal-scrollback-")
+        self._offsets = array.array("L")
+        self._first_lines = array.array("L")
+        self._file_size = 0
+        self._line_count = 0
+        self._buffer = []
+        self._buffer_size = 0
+
+    def append(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self._chunk_size:
+            self._spill()
+
+    def _spill(self):
+        data = "".join(self._buffer)
+        end = data.rfind("\n") + 1
+        if end == 0:
+            if len(data) < MAX_LINE_LENGTH:
+                self._buffer = [data]
+                return
+            data += "\n"
+            end = len(data)
+        rest = data[end:]
+        data = data[:end]
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        self._file.write(compressed)
+        # Searches read the file through mmap, so it must not be
+        # left in stdio's buffer.
+        self._file.flush()
+        self._offsets.append(self._file_size)
+        self._first_lines.append(self._line_count)
+        self._file_size += len(compressed)
+        self._line_count += data.count("\n")
+        self._buffer = [rest]
+        self._buffer_size = len(rest)
+
+    # Returns a Snapshot, which can be used from another thread.
+    def get_snapshot(self):
+        return Snapshot(self._file.fileno(), self._offsets[:],
+                        self._first_lines[:], self._file_size,
+                        "".join(self._buffer), self._line_count)
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,76 @@
+# Copyright (C) 2009 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+import re
+import unittest
+
+import terminal_scrollback
+
+
+class ScrollbackTest(unittest.TestCase):
+
+    def make_scrollback(self, lines):
+        scrollback = terminal_scrollback.Scrollback(chunk_size=1000)
+        for line in lines:
+            scrollback.append(line + "\r\n")
+        return scrollback
+
+    def test_plain_text(self):
+        self.assertEquals(terminal_scrollback.get_plain_text(
+                "\x1b[1;31mred\x1b[0m\r\n10%\r20%\r\n\x1b]0;title\x07ok\n"),
+                          "red\n20%\nok\n")
+
+    def test_search(self):
+        lines = ["line %i" % i for i in range(1000)]
+        scrollback = self.make_scrollback(lines)
+        snapshot = scrollback.get_snapshot()
+        self.assertTrue(len(snapshot.offsets) > 1)
+        self.assertEquals(snapshot.search(re.compile("line 5.7$")),
+                          [(index, "line %i" % index)
+                           for index in range(507, 598, 10)])
+        # Output that has not been spilled to the file yet is searched.
+        scrollback.append("last line")
+        self.assertEquals(
+            scrollback.get_snapshot().search(re.compile("last")),
+            [(1000, "last line")])
+        self.assertEquals(
+            len(snapshot.search(re.compile("line"), max_results=10)), 10)
+        scrollback.close()
+
+    def test_get_lines(self):
+        lines = ["line %i" % i for i in range(1000)]
+        scrollback = self.make_scrollback(lines)
+        snapshot = scrollback.get_snapshot()
+        for start in (0, 1, 99, 500, 995):
+            self.assertEquals(snapshot.get_lines(start, 5),
+                              lines[start:start + 5])
+        scrollback.close()
+
+    def test_long_lines_are_split(self):
+        scrollback = terminal_scrollback.Scrollback(chunk_size=1000)
+        for i in range(300):
+            scrollback.append("x" * 10000)
+        snapshot = scrollback.get_snapshot()
+        self.assertTrue(
+            len(snapshot.tail) < terminal_scrollback.MAX_LINE_LENGTH)
+        self.assertEquals(
+            sum(len(line) for line in snapshot.get_lines(0, 10)), 3000000)
+        scrollback.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,9 +16,11 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301 USA.
 
+import fcntl
 import itertools
 import os
 import subprocess
+import threading
 import time
 import unittest
 
@@ -26,6 +28,7 @@ import gobject
 
 import tempdir_test
 import terminal
+import terminal_client
 
 
 class TerminalSizeTest(unittest.TestCase):
@@ -39,6 +42,41 @@ class TerminalSizeTest(unittest.TestCase):
         self.assertEquals(stdout, "456 123\n")
 
 
+class PtyPoolTest(unittest.TestCase):
+
+    def test_ptys_are_fresh_and_nonblocking(self):
+        pool = terminal.PtyPool(size=2)
+        while gobject.main_context_default().iteration(False):
+            pass
+        ptys = [pool.get() for i in range(4)]
+        self.assertEquals(len(set(master_fd.fileno()
+                                  for master_fd, slave_fd in ptys)), 4)
+        for master_fd, slave_fd in ptys:
+            self.assertTrue(fcntl.fcntl(master_fd, fcntl.F_GETFL)
+                            & os.O_NONBLOCK)
+        pool.close()
+
+
+class TerminalServerTest(tempdir_test.TempDirTestCase):
+
+    def test_opening_window(self):
+        socket_path = os.path.join(self.make_temp_dir(), "socket")
+        requests = []
+        server = terminal.TerminalServer(
+            socket_path, lambda cwd, environ: requests.append((cwd, environ)))
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+                terminal_client.send_request("/some/dir", {"A": "b"},
+                                             socket_path=socket_path)))
+        thread.start()
+        while thread.isAlive():
+            gobject.main_context_default().iteration(False)
+        server.close()
+        self.assertEquals(results, [True])
+        self.assertEquals(requests, [("/some/dir", {"A": "b"})])
+        self.assertFalse(os.path.exists(socket_path))
+
+
 def get_vte_text(vte_terminal):
     # VTE updates the terminal in the event loop after a
     # non-configurable timeout, so we have to work around that.
@@ -101,6 +139,23 @@ class TerminalTest(tempdir_test.TempDirTestCase):
         self.assertEquals(term2._shell.environ["PWD"], temp_dir)
         assert term1._shell.environ is not term2._shell.environ
 
+    def test_clone_uses_spare_terminal(self):
+        temp_dir = self.make_temp_dir()
+        term1 = terminal.TerminalWidget(make_template())
+        while gobject.main_context_default().iteration(False):
+            pass
+        spare = term1._spare_terminal._spare
+        assert spare is not None
+        term1._shell.cwd.chdir(temp_dir)
+        term2 = term1.clone()
+        assert term2 is spare
+        self.assertEquals(term2._shell.cwd.get_cwd(), temp_dir)
+        self.assertEquals(term2._shell.environ["PWD"], temp_dir)
+        self.assertEquals(term2.title.get(), term2._shell.get_title())
+        # Cloning again before a new spare is ready still works.
+        term3 = term2.clone()
+        self.assertEquals(term3._shell.cwd.get_cwd(), temp_dir)
+
     def test_reading_pending_data(self):
         term = terminal.TerminalWidget(make_template())
         term._terminal.set_size(100, 100)
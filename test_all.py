@@ -3,7 +3,15 @@ import unittest
 
 from errorgui_test import *
 from setsid_helper_test import *
+from shell_complete_test import *
+from shell_history_test import *
+from shell_prompt_test import *
+from shell_recording_test import *
+from shell_suggest_test import *
 from shell_test import *
+from terminal_client_test import *
+from terminal_output_test import *
+from terminal_scrollback_test import *
 from terminal_test import *
 
 